@@ -0,0 +1,295 @@
+''' bench.py measures throughput of the preprocessing stages of pre.py '''
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+import pre
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit '
+    'víno máš markytánku dlouhá noc se prohýří díky verbíři').split()
+CHORD_NAMES = ('C', 'G', 'Am', 'F', 'Em', 'Dm', 'D7', 'G7', 'Bb', 'F#m', 'Cmaj7', 'Asus4')
+
+def synthetic_song(sections=10, lines=8, chords_per_line=4, strumming=('d-du-udu',), seed=0):
+    ''' Generates song text in the songs_txt format, every section has `lines`
+        chord/lyrics line pairs. '''
+    rnd = random.Random(seed)
+    out = ['[Info]\nTitle: Synthetic {}\nBy: bench.py\nCapo: 2\n'.format(seed)]
+    out.extend('Strumming: {}\n'.format(pattern) for pattern in strumming)
+    for j in range(sections):
+        out.append('\n[Verse]\n' if j % 2 else '\n[Chorus]\n')
+        for _ in range(lines):
+            text = ' '.join(rnd.choice(WORDS) for _ in range(2 * chords_per_line))
+            columns = sorted(rnd.sample(range(len(text)), chords_per_line))
+            chordline = ''
+            for column in columns:
+                chordline += ' ' * max(column - len(chordline), 1 if chordline else 0) + rnd.choice(CHORD_NAMES)
+            out.append(chordline + '\n' + text + '\n')
+    return ''.join(out)
+
+STRUMMING_PATTERNS = ('d-du-udu', 'd-d-d-du', 'dudu dudu', 'd-x-d-x-', 'd-dy-uzu')
+
+def synthetic_corpus(songs=200, sections=10, lines=8, chords_per_line=4, patterns=1, seed=0):
+    ''' Returns {file name: song text} of `songs` synthetic songs, each with
+        `patterns` strumming patterns picked from STRUMMING_PATTERNS. '''
+    rnd = random.Random(seed)
+    corpus = {}
+    for i in range(songs):
+        strumming = [rnd.choice(STRUMMING_PATTERNS) for _ in range(patterns)]
+        corpus['synthetic-{:05d}.txt'.format(i)] = synthetic_song(sections, lines, chords_per_line, strumming, seed + i)
+    return corpus
+
+def load_corpus(directory):
+    ''' Returns {file name: song text} of all songs that convert without errors. '''
+    corpus = {}
+    for song in sorted(pre.get_all_files_from(directory)):
+        with open(os.path.join(directory, song), 'r', encoding="utf-8") as f:
+            txt = f.read()
+        try:
+            pre.song_to_tex(txt, pre.SongOptions())
+        except Exception:
+            continue
+        corpus[song] = txt
+    return corpus
+
+def best_time(function, items, repeat):
+    ''' Returns the best of `repeat` runs of function over all items (in seconds). '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_stages(corpus, options, repeat=5):
+    ''' Returns list of (stage, songs per second). '''
+    songs = list(corpus.values())
+    parsed = [pre.parse_song(txt) for txt in songs]
+    infos = [section.info for song in parsed for section in song.sections if section.kind == pre.INFO]
+
+    stages = [
+        ('parse_song', pre.parse_song, songs),
+        ('render_info', lambda info: pre.render_info(info, options), infos),
+        ('render_song', lambda song: pre.render_song(song, options), parsed),
+        ('song_to_tex', lambda txt: pre.song_to_tex(txt, options), songs),
+    ]
+
+    return [(stage, len(items) / best_time(function, items, repeat)) for stage, function, items in stages]
+
+def bench_long_song(lines, options, repeat=5):
+    ''' Returns list of (stage, text lines per second) for one song with `lines` lines. '''
+    txt = synthetic_song(sections=lines // 100, lines=50)
+    song = pre.parse_song(txt)
+    n = len(txt.splitlines())
+
+    stages = [
+        ('parse_song', lambda: pre.parse_song(txt)),
+        ('render_song', lambda: pre.render_song(song, options)),
+        ('write_song', lambda: pre.write_song(song, options, io.StringIO())),
+    ]
+
+    return [(stage, n / best_time(lambda _: function(), [None], repeat)) for stage, function in stages]
+
+def peak_memory(function, items):
+    ''' Returns peak memory (in bytes) allocated while running function over all items. '''
+    tracemalloc.start()
+    try:
+        for item in items:
+            function(item)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_functions(corpus, options, repeat=5):
+    ''' Times the building blocks of the conversion over corpus (with
+        pre.SongOptions options). Returns list of (stage, rate, unit, peak
+        memory in bytes). '''
+    songs = list(corpus.values())
+    parsed = [pre.parse_song(txt) for txt in songs]
+    lines = [line for song in parsed for section in song.sections if section.kind == pre.MIXED for line in section.lines]
+    chordlines = [pre.chord_line(line.chords, line.positions) for line in lines]
+    infos = [pre.SONG_PARTS_RE.split(txt)[2] for txt in songs]
+    patterns = [pattern for song in parsed for section in song.sections if section.kind == pre.INFO
+        for pattern, _ in section.info['Strumming']]
+
+    sections = [section.lines for song in parsed for section in song.sections if section.kind == pre.MIXED]
+    pairs = [([pre.chord_line(line.chords, line.positions) for line in section], [line.text for line in section]) for section in sections]
+    per_section = len(lines) / len(sections) if sections else 0
+
+    stages = [
+        ('chord_positions', pre.chord_positions, chordlines, 'lines/s'),
+        ('inject_line', lambda line: pre.inject_line(line.text, line.chords, line.positions), lines, 'lines/s'),
+        # batched per section, rates are converted to lines/s below
+        ('align_chords', lambda pair: pre.align_chords(*pair), pairs, 'lines/s'),
+        ('inject_lines', pre.inject_lines, sections, 'lines/s'),
+        ('parse_song_info', lambda info: pre.parse_song_info(info, options), infos, 'songs/s'),
+        # uncached, the cache of tikz_strumming would only measure dict lookups
+        ('tikz_strumming', lambda pattern: ''.join(pre.tikz_strumming_cached_pattern.__wrapped__(p) for p in pattern.split()), patterns, 'patterns/s'),
+    ]
+    return [(stage, len(items) / best_time(function, items, repeat) * (per_section if stage in BATCHED else 1), unit,
+        peak_memory(function, items)) for stage, function, items, unit in stages if items]
+
+BATCHED = ('align_chords', 'inject_lines')
+
+def bench_split_song(corpus, options, repeat=3):
+    ''' Times pre.split_song (reading, converting and writing each song) over
+        corpus written into a temporary directory. Returns list of (stage,
+        rate, unit, peak memory in bytes). '''
+    n = sum(txt.count('\n') for txt in corpus.values())
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'songs_txt')
+        save = os.path.join(directory, 'songs_tex')
+        os.mkdir(source)
+        os.mkdir(save)
+        for song, txt in corpus.items():
+            with open(os.path.join(source, song), 'w', encoding="utf-8") as f:
+                f.write(txt)
+        locations = [os.path.join(source, song) for song in corpus]
+        convert = lambda location: pre.split_song(location, save, options)
+
+        seconds = best_time(convert, locations, repeat)
+        peak = peak_memory(convert, locations)
+    return [('split_song', len(corpus) / seconds, 'songs/s', peak), ('split_song', n / seconds, 'lines/s', peak)]
+
+def load_baseline(location):
+    try:
+        with open(location, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_baseline(location, results):
+    pre.make_sure_path_exists(os.path.dirname(location) or '.')
+    with open(location, 'w', encoding="utf-8") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+def report(group, rows, baseline, tolerance, results):
+    ''' Prints rows (stage, rate, unit[, peak memory]) of group, compared to
+        the baseline. Adds them to results, returns list of regressions.
+        Groups name their parameters, so results of differently sized runs
+        are never compared. '''
+    regressions = []
+    for row in rows:
+        stage, rate, unit = row[:3]
+        key = '{}/{} ({})'.format(group, stage, unit)
+        results[key] = rate
+        line = "{:<20} {:>12.1f} {:<12}".format(stage, rate, unit)
+        if len(row) > 3:
+            line += " {:>9.0f} KiB peak".format(row[3] / 1024)
+        if key in baseline:
+            change = rate / baseline[key] - 1
+            line += " {:>+7.1%}".format(change)
+            if change < -tolerance:
+                line += " REGRESSION"
+                regressions.append(key)
+        print(line)
+    return regressions
+
+# cumulative `python -X importtime` budget for `import pre` (in microseconds)
+# budget of pre's own import time (its regexes, namedtuples, ...), without
+# the standard library modules it imports -- their time varies with the
+# machine and would make the check pass or fail at random
+STARTUP_BUDGET_US = 10000
+
+# modules that must not be imported just by importing pre
+LAZY_MODULES = ('numpy', 'argparse', 'json', 'hashlib', 'concurrent.futures')
+
+def import_times(module='pre'):
+    ''' Imports module in a fresh interpreter, returns {imported module: (self
+        time, cumulative time) in us}. '''
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+def bench_startup(repeat=5, budget=STARTUP_BUDGET_US):
+    ''' Returns (median self import time of pre in us, median cumulative
+        import time in us, list of problems). '''
+    runs = [import_times() for _ in range(repeat)]
+    own = statistics.median(times['pre'][0] for times in runs)
+    cumulative = statistics.median(times['pre'][1] for times in runs)
+
+    problems = ['{} is imported on startup'.format(module) for module in LAZY_MODULES if module in runs[0]]
+    if own > budget:
+        problems.append('import takes {:.0f} us (budget {} us)'.format(own, budget))
+    return own, cumulative, problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks preprocessing of songs.')
+    parser.add_argument('--source', default='songs_txt')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--long-song', type=int, default=10000, metavar='LINES',
+        help='number of lines of the synthetic long song')
+    parser.add_argument('--songs', type=int, default=200, metavar='N',
+        help='number of songs of the synthetic corpus')
+    parser.add_argument('--sections', type=int, default=10, metavar='N',
+        help='sections per synthetic song')
+    parser.add_argument('--lines', type=int, default=8, metavar='N',
+        help='chord/lyrics line pairs per synthetic section')
+    parser.add_argument('--chords-per-line', type=int, default=4, metavar='N')
+    parser.add_argument('--patterns', type=int, default=1, metavar='N',
+        help='strumming patterns per synthetic song')
+    parser.add_argument('--baseline', default='bench_baseline.json',
+        help='results to compare with')
+    parser.add_argument('--save-baseline', action='store_true',
+        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='slowdown against the baseline reported as a regression (0.25 = 25 %%)')
+    parser.add_argument('--startup', action='store_true',
+        help='only check the cold import time of pre.py against its budget')
+    parser.add_argument('--budget', type=int, default=STARTUP_BUDGET_US, metavar='US')
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        own, cumulative, problems = bench_startup(args.repeat, args.budget)
+        print("import pre: {:.0f} us (budget {} us), {:.0f} us with the modules it imports".format(
+            own, args.budget, cumulative))
+        for problem in problems:
+            print("  " + problem)
+        return 1 if problems else 0
+
+    corpus = load_corpus(args.source)
+    synthetic = synthetic_corpus(args.songs, args.sections, args.lines, args.chords_per_line, args.patterns)
+    options = pre.SongOptions(capo=True, compact=True, note=True, strumming=True)
+    baseline = {} if args.save_baseline else load_baseline(args.baseline)
+    results = {}
+    regressions = []
+
+    print("{} songs from {}".format(len(corpus), args.source))
+    rows = [(stage, rate, 'items/s') for stage, rate in bench_stages(corpus, options, args.repeat)]
+    regressions += report('corpus-' + args.source, rows, baseline, args.tolerance, results)
+
+    print("synthetic song with {} lines".format(args.long_song))
+    rows = [(stage, rate, 'lines/s') for stage, rate in bench_long_song(args.long_song, options, args.repeat)]
+    regressions += report('long-song-{}'.format(args.long_song), rows, baseline, args.tolerance, results)
+
+    print("synthetic corpus of {} songs ({} sections of {} lines, {} chords per line, {} strumming patterns)".format(
+        args.songs, args.sections, args.lines, args.chords_per_line, args.patterns))
+    rows = bench_functions(synthetic, options, args.repeat) + bench_split_song(synthetic, options, args.repeat)
+    group = 'synthetic-{}x{}x{}x{}x{}'.format(args.songs, args.sections, args.lines, args.chords_per_line, args.patterns)
+    regressions += report(group, rows, baseline, args.tolerance, results)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print("Saved baseline to {}".format(args.baseline))
+    elif not baseline:
+        print("No baseline in {} (store one by --save-baseline)".format(args.baseline))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
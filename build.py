@@ -0,0 +1,317 @@
+''' build.py compiles every preprocessed song into its own PDF in parallel
+    and merges them into the final songbook (run pre.py first) '''
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+import concurrent.futures
+
+import pre
+
+BUILD_FOLDER = 'build'
+
+# files read by the preamble of songbook.tex, songs are rebuilt when they change
+PREAMBLE_INPUTS = ['chords_guitar.tex', 'chords_ukulele.tex']
+
+# the full compile (compile.sh) keeps going past errors and still writes the
+# PDF, as it always did; the other builds stop at the first error, so that
+# no broken PDF is reused by later runs
+PDFLATEX = ['pdflatex', '--shell-escape', '-interaction=nonstopmode']
+HALT_ON_ERROR = ['-halt-on-error']
+
+# preamble of songbook.tex (up to \endofdump) dumped into a custom format
+FORMAT_NAME = 'songbook-preamble'
+FORMAT_COMMAND = ['pdflatex', '-ini', '-interaction=nonstopmode', '-halt-on-error',
+    '-output-directory=' + BUILD_FOLDER, '-jobname=' + FORMAT_NAME, '&pdflatex', 'mylatexformat.ltx']
+
+INCLUDE_RE = re.compile(r'^\\include\{(.*)\}', re.MULTILINE)
+
+INSTRUMENTS = ['ukulele', 'guitar']
+# \defineukulelechord{NAME}{...}, \defineguitarchord{NAME}{...} and \defineguitarchordALT{OTHER}{NAME}
+CHORD_DEFINITION_RE = re.compile(r'\\define(?:ukulele|guitar)chord(?:\{([^}]*)\}|ALT\{[^}]*\}\{([^}]*)\})')
+
+COMMENT_RE = re.compile(r'(?<!\\)%.*')
+
+CHORD_DIAGRAMS_NAME = 'chord_diagrams.tex'
+
+def read_preamble(main_location='songbook.tex'):
+    ''' Returns everything before \\begin{document} of the main songbook file. '''
+    with open(main_location, 'r', encoding="utf-8") as f:
+        txt = f.read()
+    return txt[:txt.index('\\begin{document}')]
+
+def indexed_songs(save_folder):
+    ''' Returns names of the songs (e.g. `jolene.txt`) in songs_index.tex, in order. '''
+    with open(os.path.join(save_folder, pre.INDEX_NAME), 'r', encoding="utf-8") as f:
+        return [os.path.basename(include) for include in INCLUDE_RE.findall(f.read())]
+
+def build_key(*locations):
+    ''' Returns hash of contents of all files, used to decide whether a PDF is up to date. '''
+    digest = hashlib.sha256()
+    for location in locations:
+        with open(location, 'rb') as f:
+            digest.update(f.read())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def is_pdf(location):
+    ''' True if location is a PDF, so that empty or truncated outputs of an
+        interrupted (or faked) LaTeX run are never reused. '''
+    try:
+        with open(location, 'rb') as f:
+            return f.read(5) == b'%PDF-'
+    except OSError:
+        return False
+
+# (compiled file, seconds) of every LaTeX run, reported by --profile
+RUN_TIMES = []
+
+def run(command, log=subprocess.DEVNULL):
+    ''' Runs command, returns True on success (False also if it cannot be started). '''
+    start = time.perf_counter()
+    try:
+        return subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode == 0
+    except OSError as e:
+        if log is not subprocess.DEVNULL:
+            log.write('{}\n'.format(e))
+        return False
+    finally:
+        RUN_TIMES.append((os.path.basename(command[-1]), time.perf_counter() - start))
+
+def write_profile(location, slowest=10):
+    ''' Prints summary of RUN_TIMES and writes them into location as JSON. '''
+    runs = sorted(RUN_TIMES, key=lambda run: -run[1])
+    total = sum(seconds for _, seconds in runs)
+    print("{} LaTeX runs, {:.1f} s in total (summed over parallel runs)".format(len(runs), total))
+    for name, seconds in runs[:slowest]:
+        print("  {:<40} {:>8.2f} s".format(name, seconds))
+    pre.make_sure_path_exists(os.path.dirname(location) or '.')
+    with open(location, 'w', encoding="utf-8") as f:
+        json.dump({'total': total, 'runs': runs}, f, indent=1)
+    print("Profile written to {}".format(location))
+
+def build_format(main_location='songbook.tex'):
+    ''' Dumps the preamble of main_location (everything before \\endofdump)
+        into build/songbook-preamble.fmt, unless the format is up to date with
+        the preamble and the chord files. Returns the -fmt option for pdflatex
+        or None when the format cannot be built (e.g. mylatexformat is missing). '''
+    pre.make_sure_path_exists(BUILD_FOLDER)
+    preamble_location = os.path.join(BUILD_FOLDER, 'preamble.tex')
+    pre.write_if_changed(preamble_location, read_preamble(main_location))
+
+    format_location = os.path.join(BUILD_FOLDER, FORMAT_NAME + '.fmt')
+    key_location = os.path.join(BUILD_FOLDER, FORMAT_NAME + '.key')
+    key = build_key(preamble_location, *PREAMBLE_INPUTS)
+
+    try:
+        with open(key_location, 'r') as f:
+            current = f.read() == key and os.path.exists(format_location)
+    except OSError:
+        current = False
+
+    if not current:
+        print("Building LaTeX format {}".format(format_location))
+        if not run(FORMAT_COMMAND + [main_location]):
+            print("  failed, compiling without it (see {})".format(os.path.join(BUILD_FOLDER, FORMAT_NAME + '.log')))
+            return None
+        with open(key_location, 'w') as f:
+            f.write(key)
+
+    return '-fmt=' + os.path.join('.', BUILD_FOLDER, FORMAT_NAME)
+
+def run_pdflatex(tex_location, output_folder, runs=1, fmt=None):
+    ''' Runs pdflatex `runs` times (e.g. 2 for the table of contents), returns True on success. '''
+    jobname = os.path.splitext(os.path.basename(tex_location))[0]
+    command = PDFLATEX + HALT_ON_ERROR + ([fmt] if fmt else []) + ['-output-directory=' + output_folder, '-jobname=' + jobname, tex_location]
+    return all(run(command) for _ in range(runs))
+
+def compile_full(log_location='compile.log', use_format=True):
+    ''' Compiles songbook.tex in one pdflatex run (as compile.sh), with the
+        precompiled preamble if possible. LaTeX errors do not stop the run,
+        the PDF is written anyway. Returns True if pdflatex succeeded. '''
+    fmt = build_format() if use_format else None
+    build_chord_diagrams(used_chords('songs_tex', indexed_songs('songs_tex')), read_preamble(), fmt)
+    with open(log_location, 'w') as log:
+        return run(PDFLATEX + ([fmt] if fmt else []) + ['songbook.tex'], log)
+
+def song_document(preamble, song_location):
+    ''' Returns standalone document with a single song, page numbers are added
+        in the merge. The whole preamble is copied in, so that it is skipped
+        (up to \\endofdump) when compiled with the precompiled format. '''
+    return preamble + ('\\pagestyle{{empty}}\n'
+        '\\begin{{document}}\n'
+        '\\input{{{}}}\n'
+        '\\end{{document}}\n').format(song_location)
+
+def build_song(save_folder, song, preamble_location, fmt=None):
+    ''' Compiles a single song into build/songs/<song>.pdf unless the cached one
+        is up to date. Returns (song, 'cached' | 'compiled' | 'failed'). '''
+    folder = os.path.join(BUILD_FOLDER, 'songs')
+    song_location = save_folder + '/' + song + '.tex'
+    tex_location = os.path.join(folder, song + '.tex')
+    pdf_location = os.path.join(folder, song + '.pdf')
+    key_location = os.path.join(folder, song + '.key')
+
+    key = build_key(preamble_location, song_location, *PREAMBLE_INPUTS)
+    try:
+        with open(key_location, 'r') as f:
+            cached = f.read() == key and is_pdf(pdf_location)
+    except OSError:
+        cached = False
+    if cached:
+        return song, 'cached'
+
+    with open(preamble_location, 'r', encoding="utf-8") as f:
+        preamble = f.read()
+    pre.write_if_changed(tex_location, song_document(preamble, song_location))
+    if not run_pdflatex(tex_location, folder, fmt=fmt):
+        return song, 'failed'
+
+    with open(key_location, 'w') as f:
+        f.write(key)
+    return song, 'compiled'
+
+def build_songs(save_folder, songs, preamble_location, jobs, fmt=None):
+    ''' Compiles all songs in a pool of `jobs` LaTeX processes, returns {song: status}. '''
+    pre.make_sure_path_exists(os.path.join(BUILD_FOLDER, 'songs'))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(build_song, save_folder, song, preamble_location, fmt) for song in songs]
+        return dict(future.result() for future in futures)
+
+def defined_chords(instrument):
+    ''' Returns set of chord names defined in chords_<instrument>.tex. '''
+    with open('chords_{}.tex'.format(instrument), 'r', encoding="utf-8") as f:
+        txt = COMMENT_RE.sub('', f.read())
+    return {a or b for a, b in CHORD_DEFINITION_RE.findall(txt)}
+
+def used_chords(save_folder, songs):
+    ''' Returns sorted names of all chords used in songs (as in their \\chordlist). '''
+    manifest = pre.load_manifest(save_folder)['songs']
+    return sorted({chord for song in songs for chord in manifest.get(song, {}).get('chords', [])})
+
+def chord_diagrams_document(preamble, instrument, chords):
+    ''' Returns document with one cropped page per chord diagram. '''
+    out = [preamble, '\\usepackage[active,tightpage]{preview}\n',
+        '\\PreviewEnvironment{tikzpicture}\n', '\\begin{document}\n']
+    out.extend('\\{}chord{{{}}}\n'.format(instrument, chord) for chord in chords)
+    out.append('\\end{document}\n')
+    return ''.join(out)
+
+def build_chord_diagrams(chords, preamble, fmt=None):
+    ''' Renders every distinct chord (see used_chords) once per instrument into
+        build/chords-<instrument>.pdf and lists their pages in
+        build/chord_diagrams.tex (read by songbook.tex), so LaTeX includes
+        the cached graphics instead of drawing every chord box anew. Chords
+        not defined for an instrument (and instruments whose diagrams fail
+        to compile) are left to be drawn as before. '''
+    mapping = ['% generated by build.py, do not edit\n']
+
+    for instrument in INSTRUMENTS:
+        defined = defined_chords(instrument)
+        selected = [chord for chord in chords if chord in defined]
+        if not selected:
+            continue
+
+        location = os.path.join(BUILD_FOLDER, 'chords-{}.tex'.format(instrument))
+        changed = pre.write_if_changed(location, chord_diagrams_document(preamble, instrument, selected))
+        key_location = os.path.join(BUILD_FOLDER, 'chords-{}.key'.format(instrument))
+        pdf_location = os.path.join(BUILD_FOLDER, 'chords-{}.pdf'.format(instrument))
+        key = build_key(location, *PREAMBLE_INPUTS)
+        try:
+            with open(key_location, 'r') as f:
+                current = not changed and f.read() == key and is_pdf(pdf_location)
+        except OSError:
+            current = False
+
+        if not current:
+            print("Rendering {} {} chord diagrams".format(len(selected), instrument))
+            if not run_pdflatex(location, BUILD_FOLDER, fmt=fmt):
+                print("  failed, chords will be drawn in place")
+                continue
+            with open(key_location, 'w') as f:
+                f.write(key)
+
+        mapping.extend('\\csdef{{chorddiagram@{}@{}}}{{{}}}\n'.format(instrument, chord, page)
+            for page, chord in enumerate(selected, 1))
+
+    pre.write_if_changed(os.path.join(BUILD_FOLDER, CHORD_DIAGRAMS_NAME), ''.join(mapping))
+
+def merged_document(preamble, songs, titles):
+    ''' Returns the songbook document made of the per-song PDFs (with table of contents). '''
+    out = [preamble, '\\usepackage{pdfpages}\n', '\\begin{document}\n',
+        '\\maketitle\n', '\\tableofcontents\n', '\\clearpage\n']
+    for song in songs:
+        out.append('\\includepdf[pages=-,pagecommand={{\\thispagestyle{{plain}}}},addtotoc={{1,section,1,{{{}}},{}}}]{{{}}}\n'.format(
+            titles.get(song) or song, song, os.path.join(BUILD_FOLDER, 'songs', song + '.pdf')))
+    out.append('\\end{document}\n')
+    return ''.join(out)
+
+def merge_songbook(save_folder, songs, preamble, force=False, fmt=None):
+    ''' Assembles build/songbook.pdf from the per-song PDFs (unless neither
+        they nor the list of songs changed), returns True on success. '''
+    manifest = pre.load_manifest(save_folder)['songs']
+    titles = {song: meta.get('title') for song, meta in manifest.items()}
+    location = os.path.join(BUILD_FOLDER, 'songbook.tex')
+    changed = pre.write_if_changed(location, merged_document(preamble, songs, titles))
+    if not (changed or force) and is_pdf(os.path.join(BUILD_FOLDER, 'songbook.pdf')):
+        return True
+    return run_pdflatex(location, BUILD_FOLDER, runs=2, fmt=fmt)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compiles songs into separate PDFs and merges them.')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, metavar='N',
+        help='number of parallel LaTeX processes')
+    parser.add_argument('--full', action='store_true',
+        help='compile songbook.tex in a single run instead (as compile.sh)')
+    parser.add_argument('--no-format', action='store_true',
+        help='do not precompile the preamble into a format')
+    parser.add_argument('--profile', nargs='?', const=os.path.join(BUILD_FOLDER, 'build_profile.json'), metavar='FILE',
+        help='report the time of every LaTeX run, write it to FILE (build/build_profile.json)')
+    args = parser.parse_args(argv)
+
+    try:
+        return build(args)
+    finally:
+        if args.profile:
+            write_profile(args.profile)
+
+def build(args):
+    ''' Runs the build selected by the command line arguments, returns exit status. '''
+    if args.full:
+        if compile_full(use_format=not args.no_format):
+            return 0
+        print("Compilation failed, see compile.log")
+        return 1
+
+    fmt = None if args.no_format else build_format()
+    preamble = read_preamble()
+    preamble_location = os.path.join(BUILD_FOLDER, 'preamble.tex')
+    pre.write_if_changed(preamble_location, preamble)
+
+    songs = indexed_songs('songs_tex')
+    build_chord_diagrams(used_chords('songs_tex', songs), preamble, fmt)
+    status = build_songs('songs_tex', songs, preamble_location, args.jobs, fmt)
+
+    failed = sorted(song for song in songs if status[song] == 'failed')
+    print("Compiled {} songs ({} cached, {} failed)".format(
+        sum(1 for song in songs if status[song] == 'compiled'),
+        sum(1 for song in songs if status[song] == 'cached'), len(failed)))
+    for song in failed:
+        print("  {}: see {}".format(song, os.path.join(BUILD_FOLDER, 'songs', song + '.log')))
+    if failed:
+        return 1
+
+    compiled = any(status[song] == 'compiled' for song in songs)
+    if not merge_songbook('songs_tex', songs, preamble, force=compiled, fmt=fmt):
+        print("Merging failed, see {}".format(os.path.join(BUILD_FOLDER, 'songbook.log')))
+        return 1
+    print("Songbook written to {}".format(os.path.join(BUILD_FOLDER, 'songbook.pdf')))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+''' bundle.py packs the songs into a single file with an index and
+    compressed song texts, which is read through mmap one song at a time '''
+
+import os
+import sys
+import json
+import mmap
+import zlib
+import struct
+import hashlib
+import argparse
+import functools
+import collections
+
+import pre
+
+# magic, offset and length of the (compressed JSON) index
+HEADER = struct.Struct('<8sQQ')
+MAGIC = b'SONGBDL1'
+
+# data is the mmap of the whole file, index {song: entry} has offset and
+# length of the compressed text, its sha256 and the [Info] of the song
+Bundle = collections.namedtuple('Bundle', ['data', 'index'])
+
+def song_info(txt):
+    ''' Returns title, author, capo and tags of song text (empty if it does not parse). '''
+    try:
+        song = pre.parse_song(txt)
+    except Exception:
+        return {'title': '', 'by': '', 'capo': '', 'tags': []}
+    meta = pre.song_meta(song)
+    return {'title': meta['title'], 'by': meta['by'], 'capo': pre.song_capo(song) or '', 'tags': meta['tags']}
+
+def pack(source_folder, location):
+    ''' Packs all songs of source_folder into the bundle at location (replaced
+        atomically). Returns number of packed songs. '''
+    index = {}
+    with open(location + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        for song in sorted(pre.get_all_files_from(source_folder)):
+            with open(os.path.join(source_folder, song), 'rb') as s:
+                raw = s.read()
+            body = zlib.compress(raw, 9)
+            index[song] = dict(song_info(raw.decode('utf-8')), offset=f.tell(), length=len(body),
+                size=len(raw), sha256=hashlib.sha256(raw).hexdigest())
+            f.write(body)
+
+        data = zlib.compress(json.dumps(index, ensure_ascii=False, sort_keys=True).encode('utf-8'), 9)
+        offset = f.tell()
+        f.write(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, offset, len(data)))
+    os.replace(location + '.tmp', location)
+    return len(index)
+
+def open_bundle(location):
+    ''' Maps bundle into memory, reads only its header and index. Close by bundle.data.close(). '''
+    with open(location, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, offset, length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        data.close()
+        raise ValueError("{} is not a song bundle".format(location))
+    index = json.loads(zlib.decompress(data[offset:offset + length]).decode('utf-8'))
+    return Bundle(data, index)
+
+@functools.lru_cache(maxsize=4)
+def open_bundle_version(location, mtime, size):
+    return open_bundle(location)
+
+def cached_bundle(location):
+    ''' Returns the opened bundle, opened again only when the file changes. '''
+    stat = os.stat(location)
+    return open_bundle_version(location, stat.st_mtime_ns, stat.st_size)
+
+def read_song(bundle, song):
+    ''' Returns text of song (file name, e.g. `jolene.txt`) from bundle. '''
+    entry = bundle.index[song]
+    return zlib.decompress(bundle.data[entry['offset']:entry['offset'] + entry['length']]).decode('utf-8')
+
+def unpack(location, save_folder):
+    ''' Writes all songs of bundle into save_folder. Returns number of songs. '''
+    pre.make_sure_path_exists(save_folder)
+    bundle = open_bundle(location)
+    with bundle.data:
+        for song in bundle.index:
+            with open(os.path.join(save_folder, song), 'w', encoding="utf-8", newline='') as f:
+                f.write(read_song(bundle, song))
+    return len(bundle.index)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Packs songs into a single file bundle and back.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('pack', help='pack songs into a bundle')
+    command.add_argument('bundle')
+    command.add_argument('--source', default='songs_txt')
+
+    command = commands.add_parser('unpack', help='write songs of a bundle into a directory')
+    command.add_argument('bundle')
+    command.add_argument('--output', default='songs_txt')
+
+    command = commands.add_parser('list', help='list songs of a bundle with their [Info]')
+    command.add_argument('bundle')
+
+    command = commands.add_parser('cat', help='print songs from a bundle')
+    command.add_argument('bundle')
+    command.add_argument('songs', nargs='+', metavar='SONG')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        print("Packed {} songs into {}".format(pack(args.source, args.bundle), args.bundle))
+
+    elif args.command == 'unpack':
+        print("Unpacked {} songs into {}".format(unpack(args.bundle, args.output), args.output))
+
+    elif args.command == 'list':
+        bundle = open_bundle(args.bundle)
+        with bundle.data:
+            for song, entry in sorted(bundle.index.items()):
+                print("{:<40} {} ({})".format(song, entry['title'], entry['by']))
+
+    else:
+        bundle = open_bundle(args.bundle)
+        with bundle.data:
+            for song in args.songs:
+                if not song.endswith('.txt'):
+                    song += '.txt'
+                if song not in bundle.index:
+                    print("No song {} in {}".format(song, args.bundle), file=sys.stderr)
+                    return 1
+                sys.stdout.write(read_song(bundle, song))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
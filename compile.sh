@@ -1,5 +1,5 @@
 #!/bin/bash
 
-python3 pre.py --capo --strumming --note --compact
+python3 pre.py --capo --strumming --note --compact --incremental --jobs $(nproc) --exclude draft
 
-pdflatex --shell-escape -interaction=nonstopmode songbook.tex > compile.log
+python3 build.py --full
@@ -0,0 +1,201 @@
+''' editions.py builds all editions of the songbook (ukulele/guitar,
+    compact/full, ...) listed in editions.json from a single parse of the songs '''
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import concurrent.futures
+
+import pre
+import build
+
+CONFIG_LOCATION = 'editions.json'
+EDITIONS_FOLDER = os.path.join(build.BUILD_FOLDER, 'editions')
+
+# read in the body of songbook.tex, replaced by their per-edition counterparts
+INDEX_INPUT = '\\input{songs_tex/songs_index.tex}'
+INCLUDEONLY_RE = re.compile(r'^.*songs_includeonly.*\n', re.MULTILINE)
+
+def load_editions(location=CONFIG_LOCATION):
+    ''' Returns list of editions from the config file, dicts with name,
+        instrument, title, options (pre.SongOptions) and index_options
+        (pre.IndexOptions, selecting songs as pre.py --include/--exclude). '''
+    with open(location, 'r', encoding="utf-8") as f:
+        config = json.load(f)
+    editions = []
+    for edition in config['editions']:
+        if edition.get('instrument', 'ukulele') not in build.INSTRUMENTS:
+            raise ValueError("Unknown instrument {} of edition {}".format(edition['instrument'], edition['name']))
+        editions.append(dict(edition,
+            instrument=edition.get('instrument', 'ukulele'),
+            options=pre.SongOptions(**edition.get('options', {})),
+            index_options=pre.IndexOptions(edition.get('include', ()), edition.get('exclude', ()))))
+    return editions
+
+def songs_folder(options):
+    ''' Folder with songs rendered with SongOptions, shared by all editions using them. '''
+    return os.path.join(EDITIONS_FOLDER, 'songs-' + ('-'.join(pre.active_flags(options)) or 'plain'))
+
+def render_songs(songs, options):
+    ''' Writes songs ({song: Song}) rendered with options into their songs_folder
+        (files that did not change are left untouched). Returns {song: song_meta}
+        of the re-keyed songs. '''
+    folder = songs_folder(options)
+    pre.make_sure_path_exists(folder)
+    metas = {}
+    for song, parsed in songs.items():
+        parsed = pre.rekey_song(parsed, options)
+        pre.write_if_changed(os.path.join(folder, song + '.tex'), pre.render_song(parsed, options))
+        metas[song] = pre.song_meta(parsed)
+    for stale in set(os.listdir(folder)) - {song + '.tex' for song in songs}:
+        os.remove(os.path.join(folder, stale))
+    return metas
+
+def edition_document(main_txt, edition, songs, folder=None):
+    ''' Returns songbook.tex of an edition that inputs its songs (in order,
+        from folder, songs_folder of its options by default) and sets its
+        instrument (and title). Songs are input rather than included, so that
+        editions sharing the rendered songs can be compiled at the same time
+        without sharing .aux files. Raises ValueError if main_txt does not
+        input the songs index (INDEX_INPUT). '''
+    if INDEX_INPUT not in main_txt:
+        raise ValueError("songbook.tex does not input the songs by {}".format(INDEX_INPUT))
+    folder = folder or songs_folder(edition['options'])
+    body = ['\\toggle{}{{ukulele}}\n'.format('true' if edition['instrument'] == 'ukulele' else 'false')]
+    if edition.get('title'):
+        body.append('\\title{{{}}}\n'.format(edition['title']))
+    begin = main_txt.index('\n', main_txt.index('\\begin{document}')) + 1
+    index = ''.join('\\clearpage\\input{{{}/{}}}\\clearpage\n'.format(folder, song) for song in songs)
+
+    main_txt = main_txt[:begin] + ''.join(body) + main_txt[begin:]
+    main_txt = main_txt.replace(INDEX_INPUT, index.rstrip('\n'))
+    return INCLUDEONLY_RE.sub('', main_txt)
+
+def edition_songs(edition, metas):
+    ''' Returns songs of the edition sorted by title (see pre.write_songs_index). '''
+    index_options = edition['index_options']
+    selected = [song for song, meta in metas.items()
+        if (not index_options.include or pre.song_matches(song, meta, index_options.include))
+        and not pre.song_matches(song, meta, index_options.exclude)]
+    return sorted(selected, key=lambda song: (pre.title_key(metas[song]['title'] or song), song))
+
+def compile_edition(tex_location, song_locations, fmt):
+    ''' Compiles document of an edition (twice, for the table of contents)
+        unless neither it nor its songs changed. Returns True on success. '''
+    folder = os.path.dirname(tex_location)
+    key_location = os.path.splitext(tex_location)[0] + '.key'
+    pdf_location = os.path.splitext(tex_location)[0] + '.pdf'
+    key = build.build_key(tex_location, *song_locations, *build.PREAMBLE_INPUTS)
+    try:
+        with open(key_location, 'r') as f:
+            if f.read() == key and build.is_pdf(pdf_location):
+                return True
+    except OSError:
+        pass
+    if not build.run_pdflatex(tex_location, folder, runs=2, fmt=fmt):
+        return False
+    with open(key_location, 'w') as f:
+        f.write(key)
+    return True
+
+def build_editions(source_folder, editions, jobs=1, compile=True, use_format=True):
+    ''' Parses all songs once (for every distinct tab_size), renders them for
+        every distinct SongOptions of the editions, writes the document of
+        every edition and compiles the distinct documents in a pool of `jobs`
+        LaTeX processes. Returns ({failed edition: its log}, {song: error
+        message} of unparsable songs). '''
+    parsed = {}
+    failed_songs = {}
+    for tab_size in sorted({edition['options'].tab_size for edition in editions}):
+        parsed[tab_size], failed = pre.parse_songs(source_folder, tab_size)
+        failed_songs.update(failed)
+
+    metas = {}
+    for options in {edition['options'] for edition in editions}:
+        songs = parsed[options.tab_size]
+        print("Rendering {} songs into {}".format(len(songs), songs_folder(options)))
+        metas[options] = render_songs(songs, options)
+
+    with open('songbook.tex', 'r', encoding="utf-8", newline='') as f:
+        main_txt = f.read()
+
+    # editions with the same document (e.g. the same options and instrument)
+    # are compiled only once
+    documents = {}
+    chords = set()
+    for edition in editions:
+        selected = edition_songs(edition, metas[edition['options']])
+        used = {chord for song in selected for chord in metas[edition['options']][song]['chords']}
+        chords.update(used)
+        missing = used - build.defined_chords(edition['instrument'])
+        if missing:
+            print("Edition {}: no {} diagram of {} (only their names are shown)".format(
+                edition['name'], edition['instrument'], ', '.join(sorted(missing))))
+        document = edition_document(main_txt, edition, selected)
+        locations = [os.path.join(songs_folder(edition['options']), song + '.tex') for song in selected]
+        documents.setdefault(document, (locations, []))[1].append(edition['name'])
+
+    tex_locations = {}
+    for document, (locations, names) in documents.items():
+        folder = os.path.join(EDITIONS_FOLDER, names[0])
+        pre.make_sure_path_exists(folder)
+        tex_locations[document] = os.path.join(folder, names[0] + '.tex')
+        pre.write_if_changed(tex_locations[document], document)
+
+    if not compile:
+        return {}, failed_songs
+
+    fmt = build.build_format() if use_format else None
+    build.build_chord_diagrams(sorted(chords), build.read_preamble(), fmt)
+
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {document: pool.submit(compile_edition, tex_locations[document], locations, fmt)
+            for document, (locations, _) in documents.items()}
+        for document, future in futures.items():
+            names = documents[document][1]
+            if not future.result():
+                failed.update(dict.fromkeys(names, os.path.splitext(tex_locations[document])[0] + '.log'))
+                continue
+            pdf_location = os.path.splitext(tex_locations[document])[0] + '.pdf'
+            for name in names[1:]:
+                folder = os.path.join(EDITIONS_FOLDER, name)
+                pre.make_sure_path_exists(folder)
+                shutil.copyfile(pdf_location, os.path.join(folder, name + '.pdf'))
+            print("Edition {} written to {}".format(', '.join(names), pdf_location))
+    return failed, failed_songs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Builds all editions of the songbook from one parse of the songs.')
+    parser.add_argument('editions', nargs='*', metavar='NAME',
+        help='build only these editions (all by default)')
+    parser.add_argument('--config', default=CONFIG_LOCATION)
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, metavar='N',
+        help='number of parallel LaTeX processes')
+    parser.add_argument('--no-compile', action='store_true',
+        help='only render the songs and documents of the editions')
+    parser.add_argument('--no-format', action='store_true',
+        help='do not precompile the preamble into a format')
+    parser.add_argument('--source', default='songs_txt',
+        help='folder with the songs or a bundle packed by bundle.py')
+    args = parser.parse_args(argv)
+
+    editions = load_editions(args.config)
+    if args.editions:
+        unknown = set(args.editions) - {edition['name'] for edition in editions}
+        if unknown:
+            parser.error("unknown editions: {}".format(', '.join(sorted(unknown))))
+        editions = [edition for edition in editions if edition['name'] in args.editions]
+
+    failed, failed_songs = build_editions(args.source, editions, args.jobs, not args.no_compile, not args.no_format)
+    for song in sorted(failed_songs):
+        print("  {}: {}".format(song, failed_songs[song]))
+    for name in sorted(failed):
+        print("Edition {} failed, see {}".format(name, failed[name]))
+    return 1 if failed or failed_songs else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,369 @@
+''' importer.py converts songs from ChordPro (`[C]lyrics`) and plain
+    chord-over-lyrics text (e.g. ultimate-guitar dumps) into the songs_txt
+    format, reading directories, tar and zip archives without extracting them '''
+
+import os
+import re
+import sys
+import json
+import tarfile
+import zipfile
+import argparse
+import unicodedata
+import collections
+import concurrent.futures
+
+import pre
+
+CHORDPRO_EXTENSIONS = ('.cho', '.chopro', '.chordpro', '.crd', '.pro')
+TEXT_EXTENSIONS = ('.txt',)
+
+# Czech songs come in Windows encodings more often than not
+ENCODINGS = ('utf-8-sig', 'cp1250', 'latin-1')
+
+# {directive} or {directive: value}
+DIRECTIVE_RE = re.compile(r'\s*\{\s*(\w+)\s*(?::\s*(.*?))?\s*\}\s*')
+INLINE_CHORD_RE = re.compile(r'\[([^\]]*)\]')
+CHORDPRO_SECTIONS = {'chorus': 'Chorus', 'verse': 'Verse', 'bridge': 'Bridge', 'tab': 'Tab', 'part': 'Verse'}
+CHORDPRO_ABBREVIATIONS = {'soc': 'start_of_chorus', 'eoc': 'end_of_chorus', 'sov': 'start_of_verse',
+    'eov': 'end_of_verse', 'sob': 'start_of_bridge', 'eob': 'end_of_bridge', 'sot': 'start_of_tab',
+    'eot': 'end_of_tab', 't': 'title', 'st': 'subtitle', 'c': 'comment', 'ci': 'comment', 'cb': 'comment'}
+
+# ultimate-guitar markup of chords and tabs
+MARKUP_RE = re.compile(r'\[/?(?:ch|tab)\]')
+# `[Verse 1]`, `Chorus:` or `Intro: C G Am F`
+HEADING_RE = re.compile(r'\s*(?:\[([A-Za-z][\w\- ]*)\]|([A-Za-z][\w\-]*(?: \d+)?):)(.*)')
+# `Title: ...`, `Artist: ...`, `Capo: 2nd fret`
+HEADER_RE = re.compile(r'\s*(title|artist|by|capo|key|tuning)\s*:\s*(.+)', re.IGNORECASE)
+DECORATION_RE = re.compile(r'\W+')
+
+# result of the conversion of one file, song is the parsed Song (None on error)
+Converted = collections.namedtuple('Converted', ['source', 'song', 'error'])
+
+def decode(data):
+    if b'\0' in data:
+        raise ValueError("Binary file")
+    for encoding in ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+
+def section_name(name):
+    ''' Returns name usable in a tag (`Verse 1` -> `Verse`, `Pre chorus` -> `Pre-Chorus`,
+        `Refrén` -> `Refrén`), letters are the unicode `\\w` of pre.TAG_RE without digits. '''
+    return '-'.join(re.findall(r'[^\W\d_]+', name)).title() or 'Verse'
+
+def paragraph_section(name, lines):
+    ''' Returns Section of lines (Lines with text '' for chord-only lines), a
+        chord-only section if no line has lyrics, a text-only one if no line
+        has chords. '''
+    if not any(line.text.strip() for line in lines):
+        return pre.Section(name, pre.CHORDS, [pre.Line(None, line.chords, line.positions) for line in lines], None)
+    if not any(line.chords for line in lines):
+        return pre.Section(name, pre.TEXT, [pre.Line(line.text, [], []) for line in lines], None)
+    return pre.Section(name, pre.MIXED, lines, None)
+
+def new_info(title='', by=''):
+    return {'Title': title, 'By': by, 'Capo': [], 'Strumming': [], 'Note': [], 'Tags': []}
+
+def song_from(info, sections):
+    sections = [pre.Section('Info', pre.INFO, [], info)] + sections
+    return pre.Song(sections, pre.song_chords(sections))
+
+def add_note(info, note):
+    info['Note'] = '{}; {}'.format(info['Note'], note) if info['Note'] else note
+
+def chordpro_line(line):
+    ''' Converts `[C]Hello [G]world` into Line('Hello world', ['C', 'G'], [0, 6]).
+        Lyrics get extra spaces where chords would overlap. '''
+    text = []
+    chords = []
+    positions = []
+    column = 0
+    last = 0
+    for m in INLINE_CHORD_RE.finditer(line):
+        text.append(line[last:m.start()])
+        column += m.start() - last
+        if chords:
+            gap = positions[-1] + len(chords[-1]) + 1 - column
+            if gap > 0:
+                text.append(' ' * gap)
+                column += gap
+        chords.append(m.group(1).strip())
+        positions.append(column)
+        last = m.end()
+    text.append(line[last:])
+    return pre.Line(''.join(text).rstrip(), chords, positions)
+
+def parse_chordpro(txt, title=''):
+    ''' Parses ChordPro song into Song. '''
+    info = new_info(title)
+    sections = []
+    name = 'Verse'
+    paragraph = []
+
+    def end_paragraph():
+        if paragraph:
+            sections.append(paragraph_section(name, paragraph[:]))
+            paragraph.clear()
+
+    for line in txt.expandtabs().splitlines():
+        if line.startswith('#'):
+            continue
+        m = DIRECTIVE_RE.fullmatch(line)
+        if m:
+            directive = m.group(1).lower()
+            directive = CHORDPRO_ABBREVIATIONS.get(directive, directive)
+            value = (m.group(2) or '').strip()
+            if directive == 'title':
+                info['Title'] = value
+            elif directive in ('subtitle', 'artist') and not info['By']:
+                info['By'] = value
+            elif directive == 'capo':
+                info['Capo'] = value
+            elif directive in ('comment', 'key'):
+                add_note(info, value if directive == 'comment' else 'Key: ' + value)
+            elif directive.startswith('start_of_'):
+                end_paragraph()
+                name = section_name(value) if value else CHORDPRO_SECTIONS.get(directive[len('start_of_'):], 'Verse')
+            elif directive.startswith('end_of_'):
+                end_paragraph()
+                name = 'Verse'
+            continue
+        if not line.strip():
+            end_paragraph()
+            continue
+        paragraph.append(chordpro_line(line))
+    end_paragraph()
+
+    return song_from(info, sections)
+
+def is_chord_line(line):
+    ''' True if all words of line (except for annotations and `|`, `-`, ...) are chords. '''
+    words = [word for word in pre.ANNOTATION_SPAN_RE.sub(' ', line).split() if not DECORATION_RE.fullmatch(word)]
+    return bool(words) and all(pre.parse_chord(word) is not None for word in words)
+
+def heading(line):
+    ''' Returns (section name, chords on the same line) of a heading line, None otherwise. '''
+    m = HEADING_RE.fullmatch(line)
+    if not m or (m.group(3).strip() and not is_chord_line(m.group(3))):
+        return None
+    return section_name(m.group(1) or m.group(2)), m.group(3)
+
+def parse_chords_over_lyrics(txt, title='', by=''):
+    ''' Parses plain text with chord lines above lyrics into Song. Sections
+        are separated by blank lines and named by headings (`[Chorus]`). '''
+    info = new_info(title, by)
+    sections = []
+    name = 'Verse'
+    paragraph = []
+    lines = [MARKUP_RE.sub('', line).rstrip() for line in txt.expandtabs().splitlines()]
+
+    def end_paragraph():
+        nonlocal name
+        if paragraph:
+            sections.append(paragraph_section(name, paragraph[:]))
+            paragraph.clear()
+            name = 'Verse'
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if not line.strip():
+            end_paragraph()
+            continue
+
+        m = HEADER_RE.fullmatch(line)
+        if m and not sections and not paragraph:
+            key, value = m.group(1).lower(), m.group(2).strip()
+            if key == 'title':
+                info['Title'] = value
+            elif key in ('artist', 'by'):
+                info['By'] = value
+            elif key == 'capo':
+                info['Capo'] = re.sub(r'\D.*', '', value) or value
+            else:
+                add_note(info, '{}: {}'.format(key.title(), value))
+            continue
+
+        h = heading(line)
+        if h is not None and not is_chord_line(line):
+            end_paragraph()
+            name, rest = h
+            if rest.strip():
+                paragraph.append(pre.Line('', *pre.chord_positions(rest.strip())))
+            continue
+
+        if is_chord_line(line):
+            following = lines[i] if i < len(lines) else ''
+            if following.strip() and not is_chord_line(following) and heading(following) is None:
+                paragraph.append(pre.Line(following, *pre.chord_positions(line)))
+                i += 1
+            else:
+                paragraph.append(pre.Line('', *pre.chord_positions(line)))
+            continue
+
+        paragraph.append(pre.Line(line, [], []))
+    end_paragraph()
+
+    return song_from(info, sections)
+
+def is_chordpro(name, txt):
+    ''' Guesses the format by the extension, or by directives and chords inside of words. '''
+    if name.lower().endswith(CHORDPRO_EXTENSIONS):
+        return True
+    return bool(re.search(r'^\s*\{\s*(title|t|start_of_\w+|soc)\b', txt, re.MULTILINE | re.IGNORECASE)
+        or re.search(r'\w\[[A-H][^\]]*\]|\[[A-H][^\]]*\]\w', txt))
+
+def title_from(name):
+    ''' Returns (title, artist) from file name like `Artist - Title.txt`. '''
+    stem = os.path.splitext(os.path.basename(name))[0]
+    artist, sep, title = stem.partition(' - ')
+    if not sep:
+        return stem.replace('_', ' ').strip(), ''
+    return title.strip(), artist.strip()
+
+def convert(source, data):
+    ''' Converts file contents (bytes) into Song. Returns Converted. '''
+    try:
+        txt = decode(data)
+        title, by = title_from(source)
+        if is_chordpro(source, txt):
+            song = parse_chordpro(txt, title)
+        else:
+            song = parse_chords_over_lyrics(txt, title, by)
+        if not any(section.lines for section in song.sections):
+            raise ValueError("No lyrics or chords found")
+        # the stored text has to convert back into the same song
+        pre.parse_song(pre.song_to_txt(song))
+    except Exception as e:
+        return Converted(source, None, '{}: {}'.format(type(e).__name__, e))
+    return Converted(source, song, None)
+
+def convert_batch(batch):
+    return [convert(source, data) for source, data in batch]
+
+def is_song_file(name):
+    return name.lower().endswith(CHORDPRO_EXTENSIONS + TEXT_EXTENSIONS) and not os.path.basename(name).startswith('.')
+
+def read_sources(location):
+    ''' Yields (name, bytes) of all song files in a directory (recursively) or
+        in a tar or zip archive, one at a time, so that huge archives are
+        never held in memory or extracted to disk. '''
+    if os.path.isdir(location):
+        for root, dirs, files in os.walk(location):
+            dirs.sort()
+            for name in sorted(files):
+                if is_song_file(name):
+                    path = os.path.join(root, name)
+                    with open(path, 'rb') as f:
+                        yield os.path.relpath(path, location), f.read()
+
+    elif zipfile.is_zipfile(location):
+        with zipfile.ZipFile(location) as archive:
+            for member in archive.infolist():
+                if not member.is_dir() and is_song_file(member.filename):
+                    name = member.filename
+                    if not member.flag_bits & 0x800:
+                        # names without the UTF-8 flag are cp437 by the spec, but usually are UTF-8
+                        try:
+                            name = name.encode('cp437').decode('utf-8')
+                        except UnicodeError:
+                            pass
+                    yield name, archive.read(member)
+
+    elif tarfile.is_tarfile(location):
+        # stream mode reads members in order without seeking
+        with tarfile.open(location, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and is_song_file(member.name):
+                    yield member.name, archive.extractfile(member).read()
+
+    else:
+        raise ValueError("{} is neither a directory nor a tar or zip archive".format(location))
+
+def batches(sources, size):
+    batch = []
+    for source in sources:
+        batch.append(source)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def convert_all(sources, jobs=1, batch_size=64):
+    ''' Yields Converted for every (name, bytes) of sources. With `jobs` > 1,
+        batches of files are converted in a pool of processes, with at most
+        2 * jobs batches read ahead. '''
+    if jobs <= 1:
+        for source, data in sources:
+            yield convert(source, data)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque()
+        for batch in batches(sources, batch_size):
+            pending.append(pool.submit(convert_batch, batch))
+            if len(pending) >= 2 * jobs:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def slug(title):
+    ''' File name of song with title (`Píseň o kůňovi` -> `pisen-o-kunovi`). '''
+    folded = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii').lower()
+    return '-'.join(re.findall(r'[a-z0-9]+', folded)) or 'song'
+
+def import_songs(location, save_folder, jobs=1, overwrite=False):
+    ''' Converts all songs from directory/archive location into
+        save_folder/<slug of title>.txt. Returns report {source: {'song':
+        file name} or {'error': message}}. '''
+    pre.make_sure_path_exists(save_folder)
+    report = {}
+    written = set()
+    for converted in convert_all(read_sources(location), jobs):
+        if converted.error:
+            report[converted.source] = {'error': converted.error}
+            continue
+        name = slug(pre.song_meta(converted.song)['title'] or title_from(converted.source)[0])
+        candidate = name
+        n = 1
+        while candidate in written or (not overwrite and os.path.exists(os.path.join(save_folder, candidate + '.txt'))):
+            n += 1
+            candidate = '{}-{}'.format(name, n)
+        written.add(candidate)
+        with open(os.path.join(save_folder, candidate + '.txt'), 'w', encoding="utf-8") as f:
+            f.write(pre.song_to_txt(converted.song))
+        report[converted.source] = {'song': candidate + '.txt'}
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Imports ChordPro and chord-over-lyrics songs into songs_txt.')
+    parser.add_argument('source', help='directory, tar or zip archive with the songs')
+    parser.add_argument('--output', default='songs_txt')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, metavar='N',
+        help='number of songs converted in parallel')
+    parser.add_argument('--overwrite', action='store_true',
+        help='replace songs of the same name instead of numbering the new ones')
+    parser.add_argument('--report', default=os.path.join('build', 'import_report.json'),
+        help='where to write the result of every file as JSON')
+    args = parser.parse_args(argv)
+
+    report = import_songs(args.source, args.output, args.jobs, args.overwrite)
+
+    pre.make_sure_path_exists(os.path.dirname(args.report) or '.')
+    with open(args.report, 'w', encoding="utf-8") as f:
+        json.dump(report, f, indent=1, ensure_ascii=False, sort_keys=True)
+
+    failed = sorted(source for source, result in report.items() if 'error' in result)
+    print("Imported {} songs into {} ({} failed, report in {})".format(
+        len(report) - len(failed), args.output, len(failed), args.report))
+    for source in failed:
+        print("  {}: {}".format(source, report[source]['error']))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,58 @@
 
 import os
 import re
+import sys
 import glob
 import errno
-
-import numpy as np
-
-import argparse
+import bisect
+import functools
+import collections
+
+# json, hashlib, concurrent.futures and argparse are imported only where they
+# are needed -- the preprocessor is started per song by file watchers and CI,
+# so its startup time matters (see `bench.py --startup`)
+
+# toggles of the song header info (capo, note, strumming) and formatting
+# (compact), the key of the chords (transpose, normalize_capo, spelling,
+# see rekey_song) and the columns of a tab when parsing (tab_size, see
+# line_columns)
+SongOptions = collections.namedtuple('SongOptions',
+    ['capo', 'compact', 'note', 'strumming', 'transpose', 'normalize_capo', 'spelling', 'tab_size'],
+    defaults=[False, False, False, False, 0, False, 'auto', 1])
+
+# parsed song: sections and names of all used chords (in order of appearance)
+Song = collections.namedtuple('Song', ['sections', 'chords'])
+# lines are empty for INFO sections, info is a dict for INFO sections only
+Section = collections.namedtuple('Section', ['name', 'kind', 'lines', 'info'])
+# text is None in chord-only sections, chords are empty in text-only ones
+Line = collections.namedtuple('Line', ['text', 'chords', 'positions'])
+
+# kinds of song sections, see parse_song
+INFO = 'info'
+CHORDS = 'chords'
+TEXT = 'text'
+MIXED = 'mixed'
+
+SECTION_KINDS = {'*': CHORDS, '&': TEXT, '': MIXED}
+
+# all regular expressions are compiled once, conversion of big songbooks is dominated by them
+SONG_PARTS_RE = re.compile(r'(\[[\w\-\*\&]+\])\s*\n')
+TAG_RE = re.compile(r'\[([\w\-]+)([\*\&]?)\]')
+ANNOTATION_RE = re.compile(r'\(.*\)')
+STRUMMING_RE = re.compile(r'([duxyz\-\s]*)(\(.*\))?')
+ANNOTATION_SPAN_RE = re.compile(r'\([^\)]*\)?')
+NON_CHORD_CHARS_RE = re.compile(r'([^A-Za-z0-9/#\(\)\s]+)')
+# root (and bass) of a chord with its accidental -- As and Es are the Czech
+# names of A flat and E flat, H is B -- not preceded by a letter; only parts
+# of chord tokens that are whole chords (CHORD_RE) are transposed, so that
+# words like (Chorus) or N.C. are left alone
+CHORD_ROOT_RE = re.compile(r'(?<![A-Za-z])([A-H])(#|b|(?<=[AE])s(?!us))?')
+# separators of chords in compound tokens, e.g. `C)(G` or `G~Am`
+CHORD_SEPARATOR_RE = re.compile(r'([()~])')
+CHORD_RE = re.compile(r'([A-H])(#|b|(?<=[AE])s(?!us))?((?:maj|min|mi|m|dim|aug|sus|add|M|\d+|[#b+°ø\-])*)(?:/([A-H](?:#|b)?))?')
+# lines of only these characters (ASCII, Latin letters with diacritics,
+# dashes and quotes) take one column per character, unless tabs are wider
+NARROW_RE = re.compile(r'[\x00-\x7f\xa0-\u02ff\u1e00-\u1eff\u2010-\u2027\u2030-\u205e]*')
 
 def chord_positions(chordline):
     ''' Returns a list of chords and their respective positions in line. '''
@@ -20,6 +66,75 @@ def chord_positions(chordline):
         start += len(c)
     return chords, positions
 
+@functools.lru_cache(maxsize=None)
+def char_width(c):
+    ''' Returns number of columns taken by character c (0 for combining marks). '''
+    import unicodedata
+    if unicodedata.combining(c) or unicodedata.category(c) in ('Mn', 'Me', 'Cf'):
+        return 0
+    return 2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1
+
+def line_columns(text, tab_size=1):
+    ''' Returns the display column of every character of text and the width
+        of text. Tabs advance to the next multiple of tab_size (one column by
+        default), wide (CJK) characters take two columns and combining marks
+        (`ů` written as `u` and a combining ring) none -- they share the
+        column of their letter. '''
+    columns = []
+    column = last = 0
+    for c in text:
+        width = tab_size - column % tab_size if c == '\t' else char_width(c)
+        columns.append(column if width else last)
+        if width:
+            last = column
+        column += width
+    return columns, column
+
+def narrow_line(text, tab_size=1):
+    ''' True if every character of text takes exactly one column. '''
+    if tab_size != 1 and '\t' in text:
+        return False
+    return text.isascii() or NARROW_RE.fullmatch(text) is not None
+
+def column_index(text, column, tab_size=1):
+    ''' Returns index into text of the character at display column (positions
+        past the end of text keep their distance from it). '''
+    if narrow_line(text, tab_size):
+        return column
+    columns, width = line_columns(text, tab_size)
+    if column >= width:
+        return len(text) + column - width
+    return bisect.bisect_left(columns, column)
+
+def align_chords(chordlines, texts, tab_size=1):
+    ''' Returns list of (chords, positions) of chord lines of a section above
+        their lyrics, where positions index the lyrics. Sections of one-column
+        characters only (nearly all of them, checked at once) keep the
+        positions of chord_positions, lines with wide characters (or tabs
+        wider than tab_size=1) are aligned by their display columns (see
+        line_columns). '''
+    aligned = [chord_positions(chordline) for chordline in chordlines]
+    if narrow_line(''.join(chordlines) + ''.join(texts), tab_size):
+        return aligned
+
+    for i, (chordline, text) in enumerate(zip(chordlines, texts)):
+        chords, positions = aligned[i]
+        if narrow_line(chordline, tab_size) and narrow_line(text, tab_size):
+            continue
+        if not narrow_line(chordline, tab_size):
+            columns = line_columns(chordline, tab_size)[0]
+            positions = [columns[position] for position in positions]
+        aligned[i] = (chords, [column_index(text, position, tab_size) for position in positions])
+    return aligned
+
+def chord_line(chords, positions):
+    ''' Puts chords back onto their columns (inverse of chord_positions). '''
+    line = ''
+    for chord, position in zip(chords, positions):
+        # transposed chords can be longer than the original ones
+        line += ' ' * max(position - len(line), 1 if line else 0) + chord
+    return line
+
 
 def mini_tex_escape(line):
     ''' Handles minimal TeX escaping (F#, ...). Complicate as needed. '''
@@ -38,33 +153,68 @@ def get_all_files_from(directory):
 
 def inject_line(line, chords, positions):
     ''' Injects chords onto their positions into line. '''
-    injected_line = ""
+    injected_line = []
     last = 0
     for i in range(len(chords)):
-        if re.match("\(.*\)", chords[i]):
-            injected_line += chords[i]
+        if ANNOTATION_RE.match(chords[i]):
+            injected_line.append(chords[i])
         else:
             # try to fix chords after the last word in each line (WIP)
             if len(line) >= positions[i]:
-                injected_line += line[last:positions[i]]
+                injected_line.append(line[last:positions[i]])
             else:
                 if last < len(line):
-                    injected_line += line[last:positions[i]]
+                    injected_line.append(line[last:positions[i]])
                     N = 4 - (len(line) - last) + 2
                 else:
                     N = 4
                 #print(N)
-                injected_line += "\phantom{"+ "N"*N +"}"
+                injected_line.append("\\phantom{" + "N"*N + "}")
 
-            injected_line += "\chord{" + chords[i] + "}"
+            injected_line.append("\\chord{" + chords[i] + "}")
             last = positions[i]
-    injected_line += line[last:]
-    return mini_tex_escape(injected_line)
+    injected_line.append(line[last:])
+    return mini_tex_escape(''.join(injected_line))
+
+@functools.lru_cache(maxsize=1024)
+def is_annotation(chord):
+    return ANNOTATION_RE.match(chord) is not None
+
+def inject_lines(lines):
+    ''' Batched inject_line for Lines of a section: returns TeX of all of them
+        (each followed by `\\\\`, spaces and tabs turned into `~`), escaped at once. '''
+    parts = []
+    append = parts.append
+    for text, chords, positions in lines:
+        last = 0
+        length = len(text)
+        for chord, position in zip(chords, positions):
+            if is_annotation(chord):
+                append(chord)
+                continue
+            # same padding of chords past the end of the lyrics as inject_line
+            if length >= position:
+                append(text[last:position])
+            else:
+                if last < length:
+                    append(text[last:position])
+                    n = 4 - (length - last) + 2
+                else:
+                    n = 4
+                append("\\phantom{" + "N"*n + "}")
+            append("\\chord{" + chord + "}")
+            last = position
+        append(text[last:])
+        append('\\\\\n')
+    return mini_tex_escape(''.join(parts)).replace(' ', '~').replace('\t', '~')
 
 def inline_chord_line(line):
-    chords = line.split()
+    return inline_chords(line.split())
+
+def inline_chords(chords):
+    chords = list(chords)
     for i in range(len(chords)):
-        if re.match("\(.*\)", chords[i]):
+        if ANNOTATION_RE.match(chords[i]):
             pass
         else:
             chords[i] = "\inlinechord{" + chords[i] + "}"
@@ -115,65 +265,70 @@ def strumming_pattern(text):
 
     return '\n'.join(formated)
 
-def parse_song_info(data):
-
-    song_info = {'Title': [], 'By': [], 'Capo': [], 'Strumming': {}, 'Note': []}
-    song_info['Strumming']['Note'] = []
-    song_info['Strumming']['Pattern'] = []
-
-    for line in data.splitlines():
-        m = re.match(r'Title: (.*)', line)
-        if m:
-            song_info['Title'] = m.group(1)
-
-        m = re.match(r'By: (.*)', line)
-        if m:
-            song_info['By'] = m.group(1)
-
-        m = re.match(r'Capo: (.*)', line)
-        if m:
-            song_info['Capo'] = m.group(1)
-
-        m = re.match(r'Strumming: ([duxyz\-\s]*)(\(.*\))?', line)
-        if m:
-            #strum = strumming_pattern(m.group(1))
-            strum = tikz_strumming(m.group(1))
-            song_info['Strumming']['Note'].append(m.group(2))
-            song_info['Strumming']['Pattern'].append(strum)
-
-        m = re.match(r'Note: (.*)', line)
-        if m:
-            song_info['Note'] = m.group(1)
-
-    formated = '\\addcontentsline{{toc}}{{section}}{{{Title}}}\n'.format(**song_info)
-    formated += '{{\\Large\\bfseries {Title}}}~{{\\large\\bfseries\\itshape ({By})}}'.format(**song_info)
-    if args.capo or args.note or args.strumming:
-        formated += '\\\\[3ex]\n'
-    if song_info['Capo'] and args.capo:
-        formated += '\\textbf{{Capo}}: {Capo}\\\\[1ex]\n'.format(**song_info)
-    if song_info['Strumming'] and args.strumming:
-        for note, pattern in zip(song_info['Strumming']['Note'], song_info['Strumming']['Pattern']):
+def parse_info(lines):
+    ''' Parses lines of the [Info] section into a dict. '''
+    song_info = {'Title': [], 'By': [], 'Capo': [], 'Strumming': [], 'Note': [], 'Tags': []}
+
+    for line in lines:
+        key, sep, value = line.partition(': ')
+        if not sep:
+            continue
+
+        if key in ('Title', 'By', 'Capo', 'Note'):
+            song_info[key] = value
+
+        elif key == 'Tags':
+            song_info['Tags'] = [tag.strip() for tag in value.split(',') if tag.strip()]
+
+        elif key == 'Strumming':
+            m = STRUMMING_RE.match(value)
+            song_info['Strumming'].append((m.group(1), m.group(2)))
+
+    return song_info
+
+def render_info(song_info, options):
+    ''' Renders song header from info parsed by parse_info. '''
+    formated = ['\\addcontentsline{{toc}}{{section}}{{{Title}}}\n'.format(**song_info)]
+    formated.append('{{\\Large\\bfseries {Title}}}~{{\\large\\bfseries\\itshape ({By})}}'.format(**song_info))
+    if options.capo or options.note or options.strumming:
+        formated.append('\\\\[3ex]\n')
+    if song_info['Capo'] and options.capo:
+        formated.append('\\textbf{{Capo}}: {Capo}'.format(**song_info))
+        formated.append('\\\\[1ex]\n')
+    if options.strumming:
+        for pattern, note in song_info['Strumming']:
             if note:
                 note = ' ' + note
             else:
                 note = ''
-            formated += '\\textbf{{Strumming}}{}:\\\\[1ex]\n{}\\\\[1ex]\n'.format(note, pattern)
-    if song_info['Note'] and args.note:
-        formated += '\\textbf{{Note}}: {Note}\\\\[1ex]\n'.format(**song_info)
+            #strum = strumming_pattern(pattern)
+            strum = tikz_strumming(pattern)
+            formated.append('\\textbf{{Strumming}}{}:\\\\[1ex]\n{}'.format(note, strum))
+            formated.append('\\\\[1ex]\n')
+    if song_info['Note'] and options.note:
+        formated.append('\\textbf{{Note}}: {Note}'.format(**song_info))
+        formated.append('\\\\[1ex]\n')
 
     # formated text always ends with something like '\\[3ex]\n' - this creates
-    # an extra space after the last line -- delete in (i know it's a bad practice) :-)
-    formated = re.sub(r'\\\\\[[0-9]ex\]\n$', '\n\n', formated)
+    # an extra space after the last line -- replace it
+    if formated[-1] in ('\\\\[1ex]\n', '\\\\[3ex]\n'):
+        formated[-1] = '\n\n'
 
-    return formated
+    return ''.join(formated)
 
-def split_song(file_location, save_folder):
-    ''' Handles anotated txt file. Allowed tags (and file structure):
+def parse_song_info(data, options):
+    ''' Renders song header from the text of the [Info] section. '''
+    return render_info(parse_info(data.splitlines()), options)
+
+def parse_song(txt, tab_size=1):
+    ''' Parses annotated song text into a Song. Allowed tags (and file structure):
         [Info]
             Title:
             By:
             Capo:
             Strumming:
+            Note:
+            Tags: (comma separated, used to select songs for the index)
 
         If the tag ends with `*`, it contains only chords:
         e.g. [Intro*], [Outro*], [Ending*], ...
@@ -184,104 +339,365 @@ def split_song(file_location, save_folder):
         Otherwise, it contains chords and text lins:
         e.g. [Bridge], [Pre-Chorus], [Interlude]...
 
+        Every section is parsed exactly once into Lines, so that both the
+        used chords and the rendered output are derived from the Song alone.
+        Chords are placed by display columns, a tab takes tab_size columns.
     '''
-    with open(file_location, 'r', encoding="utf-8") as f:
-        txt = f.read()
-
-    with open(save_folder + '/' + file_location.split("/")[-1] + '.tex', 'w', encoding="utf-8") as f:
-        song_parts = re.split(r'(\[[\w\-\*\&]+\])\s*\n', txt)
-
-        if song_parts[0] == '':
-            song_parts.pop(0)
-
-        tags = song_parts[::2]
-        data = song_parts[1::2]
-
-        for j, tag in enumerate(tags):
-            tags[j] = tag.strip()
-
-        used_chords = ''
-
-        for j, (tag, dat) in enumerate(zip(tags, data)):
-
-            if tag.lower() == '[info]':
-                pass
-
-            elif re.match(r'\[[\w\-]+\*\]', tag.lower()):
-                used_chords += dat.strip() + ' '
-
-            elif re.match(r'\[[\w\-]+\]', tag.lower()):
-                lines = [s for s in dat.splitlines() if s]
-                chordlines = lines[::2]
-                used_chords += ' ' + ' '.join(chordlines) + ' '
-
-            elif re.match(r'\[[\w\-]+\&\]', tag.lower()):
-                pass
-
-            else:
-                print("Unidentified tag {}".format(tag))
-                raise
-
-        # remove all characters except for 'A-Z', 'a-z', '0-9', '/', '#', '()', and whitespace
-        used_chords = re.sub(r'([^A-Za-z0-9/#\(\)\s]+)',' ',used_chords)
-
-        used_chords = re.sub(r'(\(.*\))',' ',used_chords)
-
-        # LaTeX does not like '#' character to be used in macros
-        # -- better replace it and deal with it in LaTeX
-        used_chords = re.sub('#','+',used_chords)
-
-        used_chords = ', '.join(set(used_chords.split()))
-        # print(used_chords)
-
-        for j, (tag, dat) in enumerate(zip(tags, data)):
-
-            tag_string = re.sub(r'[\[\]\&\*]','',tag.title())
-
-            if tag.lower() == '[info]':
-                f.write(parse_song_info(dat) + '\n' + '\\bigskip\n')
-
-                f.write('\n\\chordlist{{{}}}\\\\\n'.format(used_chords))
-
-            elif re.match(r'\[[\w\-]+\*\]', tag.lower()):
-                if args.compact:
-                    f.write('\n\\textbf{{{}}}:~'.format(tag_string) + '{{\\sffamily {}}}\n'.format(inline_chord_line(dat.strip())) + '\\\\\n')
-                else:
-                    f.write('\n\\textbf{{{}}}:\\\\[1ex]\n'.format(tag_string) + '{{\\sffamily {}}}\n'.format(inline_chord_line(dat.strip())) + '\\\\\n')
+    song_parts = SONG_PARTS_RE.split(txt)
 
-            elif re.match(r'\[[\w\-]+\&?\]', tag.lower()):
+    if song_parts[0] == '':
+        song_parts.pop(0)
 
-                lines = [s for s in dat.splitlines() if s]
+    sections = []
+    for tag, dat in zip(song_parts[::2], song_parts[1::2]):
+        tag = tag.strip()
+        m = TAG_RE.fullmatch(tag)
+        if not m:
+            raise ValueError("Unidentified tag {}".format(tag))
 
-                # print(tag)
+        name, suffix = m.groups()
+        if name.lower() == 'info' and not suffix:
+            kind = INFO
+        else:
+            kind = SECTION_KINDS[suffix]
 
-                if re.match(r'\[[\w\-]+\]', tag.lower()):
-                    chordlines = lines[::2]
-                    textlines = lines[1::2]
+        lines = [s for s in dat.splitlines() if s]
+        info = None
 
-                    parsed = ''
-                    for i in range(len(chordlines)):
-                        chords, positions = chord_positions(chordlines[i])
-                        # print(chords)
-                        injected_line = inject_line(textlines[i], chords, positions)
-                        # print(injected_line + "\\\\")
-                        parsed += injected_line + '\\\\\n'
+        if kind == INFO:
+            info = parse_info(lines)
+            lines = []
 
-                elif re.match(r'\[[\w\-]+\&\]', tag.lower()):
-                    parsed = '\\\\\n'.join(lines) + '\\\\\n'
+        elif kind == CHORDS:
+            lines = [Line(None, *chord_positions(s)) for s in lines]
 
-                else:
-                    print("Unidentified tag {}".format(tag))
-                    raise
+        elif kind == TEXT:
+            lines = [Line(s, [], []) for s in lines]
 
-                parsed = parsed.replace(' ','~')
-
-                if args.compact:
-                    f.write('\n\\textbf{{{}}}:~'.format(tag_string))
+        else:
+            if len(lines) % 2:
+                raise ValueError("Chord line without lyrics in {}: {}".format(tag, lines[-1].strip()))
+            texts = lines[1::2]
+            lines = [Line(text, *aligned) for text, aligned in zip(texts, align_chords(lines[::2], texts, tab_size))]
+
+        sections.append(Section(name.title(), kind, lines, info))
+
+    return Song(sections, song_chords(sections))
+
+SECTION_SUFFIXES = {kind: suffix for suffix, kind in SECTION_KINDS.items()}
+
+def song_to_txt(song):
+    ''' Returns annotated song text of Song (the inverse of parse_song), used
+        to store songs converted from other formats. '''
+    out = []
+    for section in song.sections:
+        if section.kind == INFO:
+            info = section.info
+            out.append('[Info]\n')
+            for key in ('Title', 'By', 'Capo'):
+                if info[key]:
+                    out.append('{}: {}\n'.format(key, info[key]))
+            for pattern, note in info['Strumming']:
+                out.append('Strumming: {}{}\n'.format(pattern, note or ''))
+            if info['Note']:
+                out.append('Note: {}\n'.format(info['Note']))
+            if info['Tags']:
+                out.append('Tags: {}\n'.format(', '.join(info['Tags'])))
+        else:
+            out.append('[{}{}]\n'.format(section.name, SECTION_SUFFIXES[section.kind]))
+            for line in section.lines:
+                if section.kind == CHORDS:
+                    out.append(chord_line(line.chords, line.positions) + '\n')
+                elif section.kind == TEXT:
+                    out.append(line.text + '\n')
                 else:
-                    f.write('\n\\textbf{{{}}}:\\\\[1ex]\n'.format(tag_string))
+                    # empty lines are skipped by parse_song, keep the pairs intact
+                    out.append('{}\n{}\n'.format(chord_line(line.chords, line.positions) or ' ', line.text or ' '))
+        out.append('\n')
+    return ''.join(out)
+
+def chord_names(chords):
+    ''' Returns chord names (for \\chordlist) from chords of one line, skipping
+        (parenthesised) annotations. '''
+    # remove all characters except for 'A-Z', 'a-z', '0-9', '/', '#', '()', and whitespace
+    line = NON_CHORD_CHARS_RE.sub(' ', ' '.join(chords))
+
+    line = ANNOTATION_SPAN_RE.sub(' ', line)
+
+    # LaTeX does not like '#' character to be used in macros
+    # -- better replace it and deal with it in LaTeX
+    return line.replace(')', ' ').replace('#', '+').split()
+
+def song_chords(sections):
+    ''' Returns names of all chords in sections, in order of first appearance. '''
+    used_chords = {}
+    for section in sections:
+        for line in section.lines:
+            for chord in chord_names(line.chords):
+                used_chords.setdefault(chord)
+    return tuple(used_chords)
+
+# parsed chord name, e.g. Chord('F', '#', 'm7', 'A') for F#m7/A
+Chord = collections.namedtuple('Chord', ['root', 'accidental', 'quality', 'bass'])
+
+NOTE_INDEX = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11, 'H': 11}
+ACCIDENTAL_SHIFT = {'': 0, '#': 1, 'b': -1, 's': -1}
+SHARP_NAMES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+FLAT_NAMES = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B')
+# major keys written with flats (F, Bb, Eb, Ab, Db)
+FLAT_KEYS = {5, 10, 3, 8, 1}
+
+@functools.lru_cache(maxsize=4096)
+def parse_chord(name):
+    ''' Parses chord name into a Chord, returns None for anything else (annotations, ...). '''
+    m = CHORD_RE.fullmatch(name)
+    if not m:
+        return None
+    root, accidental, quality, bass = m.groups()
+    return Chord(root, accidental or '', quality, bass)
+
+def note_index(note):
+    ''' Returns semitone (0 = C) of note name like `C`, `F#`, `Bb` or `As`. '''
+    return (NOTE_INDEX[note[0]] + ACCIDENTAL_SHIFT[note[1:]]) % 12
+
+@functools.lru_cache(maxsize=64)
+def transposition_table(semitones, flats):
+    ''' Returns {note name: transposed note name} for all spellings of all
+        twelve notes, computed once per interval and spelling. '''
+    names = FLAT_NAMES if flats else SHARP_NAMES
+    notes = [root + accidental for root in NOTE_INDEX for accidental in ('', '#', 'b')] + ['As', 'Es']
+    return {note: names[(note_index(note) + semitones) % 12] for note in notes}
+
+@functools.lru_cache(maxsize=4096)
+def transpose_chord(name, semitones, flats=False):
+    ''' Transposes all roots and basses in chord name (also in compound
+        tokens like `C)(G`) by semitones, keeping the chord quality. Parts
+        that are not chords (`N.C.`, `(Chorus)`, ...) are kept as they are. '''
+    table = transposition_table(semitones % 12, flats)
+    return ''.join(CHORD_ROOT_RE.sub(lambda m: table[m.group(0)], part) if CHORD_RE.fullmatch(part) else part
+        for part in CHORD_SEPARATOR_RE.split(name))
+
+def song_capo(song):
+    ''' Returns capo of song as int, None if it has none (or not a plain number like `1/3`). '''
+    for section in song.sections:
+        if section.kind == INFO and section.info['Capo'] and section.info['Capo'].strip().isdigit():
+            return int(section.info['Capo'])
+    return None
+
+def prefers_flats(song, semitones):
+    ''' True if the key of song (guessed from its first chord) transposed by
+        semitones is usually written with flats. '''
+    for section in song.sections:
+        for line in section.lines:
+            for name in line.chords:
+                chord = parse_chord(name)
+                if chord is None:
+                    continue
+                key = note_index(chord.root + chord.accidental) + semitones
+                if chord.quality.startswith('m') and not chord.quality.startswith('maj'):
+                    key += 3
+                return key % 12 in FLAT_KEYS
+    return False
+
+def rekey_song(song, options):
+    ''' Transposes song parsed by parse_song by options.transpose semitones.
+        With options.normalize_capo, chords of songs with a capo are moved up
+        to the key they sound in without it (and Capo is dropped).
+        options.spelling is `sharp`, `flat` or `auto` (by the target key).
+        Only chord names change, their positions stay the same, so that the
+        chords stay above the same lyrics. '''
+    semitones = options.transpose
+    sections = song.sections
+    if options.normalize_capo:
+        capo = song_capo(song)
+        if capo:
+            semitones += capo
+            sections = [section._replace(info=dict(section.info, Capo='')) if section.kind == INFO else section
+                for section in sections]
+
+    if semitones % 12 == 0:
+        return song._replace(sections=sections)
+
+    if options.spelling == 'auto':
+        flats = prefers_flats(song, semitones)
+    else:
+        flats = options.spelling == 'flat'
+
+    sections = [section._replace(lines=[line._replace(chords=[transpose_chord(chord, semitones, flats) for chord in line.chords])
+        for line in section.lines]) for section in sections]
+    return Song(sections, song_chords(sections))
+
+def tex_fragments(song, options):
+    ''' Yields TeX source of song parsed by parse_song piece by piece. '''
+    for section in song.sections:
+        yield from section_fragments(song, section, options)
+
+def section_fragments(song, section, options):
+    ''' Yields TeX source of one section of song. '''
+    if section.kind == INFO:
+        yield render_info(section.info, options)
+        yield '\n\\bigskip\n'
+
+        yield '\n\\chordlist{{{}}}\\\\\n'.format(', '.join(song.chords))
+        return
+
+    if options.compact:
+        yield '\n\\textbf{{{}}}:~'.format(section.name)
+    else:
+        yield '\n\\textbf{{{}}}:\\\\[1ex]\n'.format(section.name)
+
+    yield '{\\sffamily '
+
+    if section.kind == CHORDS:
+        yield inline_chords(chord for line in section.lines for chord in line.chords)
+        yield '}\n\\\\\n'
+        return
+
+    if section.kind == MIXED:
+        yield inject_lines(section.lines)
+    else:
+        for line in section.lines:
+            yield line.text.replace(' ','~').replace('\t', '~')
+            yield '\\\\\n'
+
+    yield '}\n'
+
+def write_song(song, options, f):
+    ''' Writes TeX source of song parsed by parse_song into text stream f. '''
+    f.writelines(tex_fragments(song, options))
+
+def render_song(song, options):
+    ''' Renders song parsed by parse_song into TeX source. '''
+    return ''.join(tex_fragments(song, options))
+
+def song_to_tex(txt, options):
+    ''' Converts annotated song text into TeX source, without touching any files. '''
+    return render_song(rekey_song(parse_song(txt, options.tab_size), options), options)
+
+def split_song(file_location, save_folder, options):
+    ''' Converts annotated txt file (see parse_song) into save_folder/<name>.tex. '''
+    with open(file_location, 'r', encoding="utf-8") as f:
+        song = rekey_song(parse_song(f.read(), options.tab_size), options)
 
-                f.write('{{\\sffamily {}}}\n'.format(parsed))
+    with open(save_folder + '/' + file_location.split("/")[-1] + '.tex', 'w', encoding="utf-8") as f:
+        write_song(song, options, f)
+
+    return song
+
+def source_songs(source):
+    ''' Returns songs of source, a folder of songs or a bundle file (see bundle.py). '''
+    if os.path.isdir(source):
+        return get_all_files_from(source)
+    import bundle
+    return list(bundle.cached_bundle(source).index)
+
+def read_source_song(source, song):
+    ''' Returns text of song from source (a folder or a bundle). '''
+    if os.path.isdir(source):
+        with open(os.path.join(source, song), 'r', encoding="utf-8") as f:
+            return f.read()
+    import bundle
+    return bundle.read_song(bundle.cached_bundle(source), song)
+
+def source_hash(source, song):
+    ''' Returns sha256 hex digest of song from source, bundles store it in their index. '''
+    if os.path.isdir(source):
+        return file_hash(os.path.join(source, song))
+    import bundle
+    return bundle.cached_bundle(source).index[song]['sha256']
+
+def split_source_song(source, song, save_folder, options):
+    ''' Same as split_song for song of source (a folder or a bundle). '''
+    if os.path.isdir(source):
+        return split_song(source + '/' + song, save_folder, options)
+    parsed = rekey_song(parse_song(read_source_song(source, song), options.tab_size), options)
+    with open(save_folder + '/' + song + '.tex', 'w', encoding="utf-8") as f:
+        write_song(parsed, options, f)
+    return parsed
+
+def parse_songs(source_folder, tab_size=1):
+    ''' Parses all songs of source_folder (or a bundle), returns ({song: Song}, {song: error message}). '''
+    songs = {}
+    failed = {}
+    for song in sorted(source_songs(source_folder)):
+        try:
+            songs[song] = parse_song(read_source_song(source_folder, song), tab_size)
+        except Exception as e:
+            failed[song] = '{}: {}'.format(type(e).__name__, e)
+    return songs, failed
+
+def song_meta(song):
+    ''' Returns title, author and tags of parsed song (from its first [Info]
+        section) and the names of its chords. '''
+    for section in song.sections:
+        if section.kind == INFO:
+            info = section.info
+            return {'title': info['Title'] or '', 'by': info['By'] or '', 'tags': info['Tags'], 'chords': list(song.chords)}
+    return {'title': '', 'by': '', 'tags': [], 'chords': list(song.chords)}
+
+# stages of the conversion of one song timed by profile_song: header is the
+# [Info] section (with the TikZ strumming patterns), inject the sections with
+# chords above lyrics, text the chord-only and text-only sections
+PROFILE_STAGES = ('read', 'parse', 'header', 'inject', 'text', 'write')
+SECTION_STAGES = {INFO: 'header', MIXED: 'inject', CHORDS: 'text', TEXT: 'text'}
+
+def profile_song(source, name, save_folder, options):
+    ''' Same as split_source_song, but also returns the time spent in every
+        stage (see PROFILE_STAGES) and counts of sections, lines, chords and
+        strumming patterns of the song. Returns (song, profile). '''
+    import time
+
+    times = dict.fromkeys(PROFILE_STAGES, 0.0)
+    start = time.perf_counter()
+    txt = read_source_song(source, name)
+    times['read'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    song = rekey_song(parse_song(txt, options.tab_size), options)
+    times['parse'] = time.perf_counter() - start
+
+    fragments = []
+    for section in song.sections:
+        start = time.perf_counter()
+        fragments.extend(section_fragments(song, section, options))
+        times[SECTION_STAGES[section.kind]] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(save_folder + '/' + name + '.tex', 'w', encoding="utf-8") as f:
+        f.writelines(fragments)
+    times['write'] = time.perf_counter() - start
+
+    counters = {
+        'sections': len(song.sections),
+        'lines': sum(len(section.lines) for section in song.sections),
+        'chords': sum(len(line.chords) for section in song.sections for line in section.lines),
+        'strumming': sum(len(section.info['Strumming']) for section in song.sections if section.kind == INFO),
+    }
+    return song, {'stages': times, 'total': sum(times.values()), 'counters': counters}
+
+def profile_report(profiles, slowest=10):
+    ''' Sums up {song: profile} from profile_song into a report with totals
+        per stage, total counters and the slowest songs. '''
+    totals = {stage: sum(p['stages'][stage] for p in profiles.values()) for stage in PROFILE_STAGES}
+    counters = collections.Counter()
+    for p in profiles.values():
+        counters.update(p['counters'])
+    ranking = sorted(profiles, key=lambda song: -profiles[song]['total'])
+    return {'songs': profiles, 'stages': totals, 'total': sum(totals.values()),
+        'counters': dict(counters), 'slowest': ranking[:slowest]}
+
+def print_profile(report):
+    ''' Prints human readable summary of profile_report. '''
+    total = report['total'] or 1
+    print("Profile of {} songs, {:.1f} ms in total".format(len(report['songs']), 1000 * report['total']))
+    for stage in PROFILE_STAGES:
+        print("  {:<8} {:>9.2f} ms {:>6.1%}".format(stage, 1000 * report['stages'][stage], report['stages'][stage] / total))
+    print("  " + ", ".join("{} {}".format(count, name) for name, count in sorted(report['counters'].items())))
+    print("Slowest songs:")
+    for song in report['slowest']:
+        p = report['songs'][song]
+        stage = max(PROFILE_STAGES, key=lambda stage: p['stages'][stage])
+        print("  {:<40} {:>8.2f} ms (mostly {})".format(song, 1000 * p['total'], stage))
 
 def make_sure_path_exists(path):
     try:
@@ -291,35 +707,43 @@ def make_sure_path_exists(path):
             raise
 
 def tikz_strumming(line):
-    out = ''
-    for l in line.split():
-        out += tikz_strumming_single_pattern(l)
+    return ''.join(tikz_strumming_single_pattern(l) for l in line.split())
 
-    return out
+# number of different patterns kept by tikz_strumming_single_pattern
+STRUMMING_CACHE_SIZE = 256
 
 def tikz_strumming_single_pattern(line):
-    out = r'\begin{tikzpicture}'
-    out += r'\coordinate (A0) at (0,0.25);' \
+    ''' Returns tikzpicture of a single strumming pattern (e.g. `d-du-udu`).
+        Songbooks keep repeating a handful of patterns, so the pictures are
+        cached (see strumming_cache_info). '''
+    return tikz_strumming_cached_pattern(line.strip())
+
+@functools.lru_cache(maxsize=STRUMMING_CACHE_SIZE)
+def tikz_strumming_cached_pattern(line):
+    out = [r'\begin{tikzpicture}']
+    out.append(r'\coordinate (A0) at (0,0.25);' \
     	+ r'\coordinate (A1) at (0,0);' \
     	+ r'\coordinate (A2) at (0.5,0);' \
-    	+ r'\coordinate (A3) at (0.5,0.25);'
-
-    line = line.strip()
+    	+ r'\coordinate (A3) at (0.5,0.25);')
 
     n = 2
     for j, a in enumerate([line[i:i+n] for i in range(0, len(line), n)]):
-        out += tikz_strumming_part(j, a)
+        out.append(tikz_strumming_part(j, a))
 
-    out += r'\end{tikzpicture}'
-    return out
+    out.append(r'\end{tikzpicture}')
+    return ''.join(out)
 
-def tikz_strumming_part(j, code):
+def strumming_cache_info():
+    ''' Returns (hits, misses) of the strumming pattern cache. '''
+    info = tikz_strumming_cached_pattern.cache_info()
+    return info.hits, info.misses
 
-    out = ''
-    for i in np.arange(4):
-        out += r'\coordinate (A%d) at ($(A%d) + (1,0)$);' % (i,i)
+# moves the four corner coordinates of a beat one step to the right
+STRUMMING_STEP = ''.join(r'\coordinate (A%d) at ($(A%d) + (1,0)$);' % (i,i) for i in range(4))
 
+def tikz_strumming_part(j, code):
 
+    out = STRUMMING_STEP
     out += r'\path [draw] (A0)--(A1)--(A2)--(A3);'
     out += r'\path [draw] ($ (A1) + (0,0.05) $)--($ (A2) + (0,0.05) $);'
     out += r'\node [above=0.0 of A0] {\footnotesize \color{gray} %d};' %(j+1)
@@ -346,17 +770,398 @@ def tikz_strumming_resolve_code(node, code):
 
     return out
 
-parser = argparse.ArgumentParser(description='Preprocessing...')
+# bump whenever the generated TeX changes for the same input, so that
+# incremental builds do not keep outputs of an older generator around
+GENERATOR_VERSION = 5
 
-parser.add_argument('--capo', action='store_true')
-parser.add_argument('--compact', action='store_true')
-parser.add_argument('--note', action='store_true')
-parser.add_argument('--strumming', action='store_true')
+MANIFEST_NAME = '.manifest.json'
 
-args = parser.parse_args()
+def file_hash(file_location):
+    ''' Returns sha256 hex digest of file contents. '''
+    import hashlib
+    with open(file_location, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
-make_sure_path_exists('songs_tex')
+def load_manifest(save_folder):
+    ''' Loads manifest of the last build, returns empty one if missing/broken. '''
+    import json
+    try:
+        with open(os.path.join(save_folder, MANIFEST_NAME), 'r', encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest.setdefault('songs', {})
+    return manifest
+
+def save_manifest(save_folder, manifest):
+    ''' Atomically replaces the manifest, so an interrupted run never leaves it half-written. '''
+    import json
+    location = os.path.join(save_folder, MANIFEST_NAME)
+    with open(location + '.tmp', 'w', encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(location + '.tmp', location)
+
+def active_flags(options):
+    ''' Returns options that differ from the defaults, e.g. ['capo', 'transpose=2']. '''
+    flags = []
+    for flag, default in SongOptions._field_defaults.items():
+        value = getattr(options, flag)
+        if value != default:
+            flags.append(flag if value is True else '{}={}'.format(flag, value))
+    return sorted(flags)
+
+def preprocess_song(source_folder, save_folder, options, song, profile=False):
+    ''' Converts one song, returns an error message instead of raising so
+        that a single broken song does not stop the whole batch, song_meta,
+        hits and misses of the strumming cache of this (worker) process and,
+        with `profile`, the profile from profile_song (None otherwise). '''
+    hits, misses = strumming_cache_info()
+    error = meta = timings = None
+    try:
+        if profile:
+            song, timings = profile_song(source_folder, song, save_folder, options)
+        else:
+            song = split_source_song(source_folder, song, save_folder, options)
+        meta = song_meta(song)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    new_hits, new_misses = strumming_cache_info()
+    return error, meta, new_hits - hits, new_misses - misses, timings
+
+def preprocess_songs(source_folder, save_folder, options, incremental=False, jobs=1, only=None, profile=None, profiler=None):
+    ''' Converts all songs from source_folder (or a bundle, see bundle.py) to save_folder.
+
+        Every run records the source hash and song_meta of each song together
+        with the flags and GENERATOR_VERSION in a manifest. Outputs of removed
+        sources are deleted (and dropped from the manifest, which the index is
+        generated from). With `incremental`, songs whose hash (and
+        flags/version) did not change are skipped and their outputs left
+        untouched.
+
+        With `jobs` > 1 the songs are converted in a pool of processes.
+        With `only` (a set of song file names), other songs are not even
+        hashed (used by watch mode).
+        With `profile` (a dict), the profile_song profile of every converted
+        song is stored in it. With `profiler` (a cProfile.Profile), the
+        conversions are run under it, which requires `jobs` == 1.
+        Returns a dict of failed songs and their error messages.
+    '''
+    old = load_manifest(save_folder)
+    manifest = {'version': GENERATOR_VERSION, 'flags': active_flags(options), 'songs': {}}
+    same_setup = old.get('version') == manifest['version'] and old.get('flags') == manifest['flags']
+
+    songs = sorted(source_songs(source_folder))
+
+    digests = {}
+    todo = []
+    for song in songs:
+        if only is not None and song not in only:
+            if song in old['songs']:
+                manifest['songs'][song] = old['songs'][song]
+            continue
+        digests[song] = source_hash(source_folder, song)
+        output = save_folder + '/' + song + '.tex'
+        if incremental and same_setup and old['songs'].get(song, {}).get('hash') == digests[song] and os.path.exists(output):
+            manifest['songs'][song] = old['songs'][song]
+        else:
+            todo.append(song)
+
+    present = set(songs)
+    removed = set(old['songs']) - present
+
+    failed = {}
+    cache_hits = cache_misses = 0
+    convert = functools.partial(preprocess_song, source_folder, save_folder, options, profile=profile is not None)
+    if profiler is not None:
+        convert = functools.partial(profiler.runcall, convert)
+
+    try:
+        if jobs > 1 and len(todo) > 1:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(convert, todo, chunksize=max(1, len(todo) // (4 * jobs))))
+        else:
+            results = map(convert, todo)
+
+        for song, (error, meta, hits, misses, timings) in zip(todo, results):
+            print("Preprocessing song {}".format(song))
+            cache_hits += hits
+            cache_misses += misses
+            if timings is not None:
+                profile[song] = timings
+            if error:
+                failed[song] = error
+            else:
+                manifest['songs'][song] = dict(meta, hash=digests[song])
+
+        for song in sorted(removed):
+            print("Removing output of deleted song {}".format(song))
+            try:
+                os.remove(save_folder + '/' + song + '.tex')
+            except FileNotFoundError:
+                pass
+            removed.discard(song)
+    finally:
+        # keep entries of songs not reached before an interruption (and of
+        # deleted songs whose outputs were not removed), so that their
+        # outputs are still tracked
+        if same_setup:
+            for song in old['songs']:
+                if song in removed or (song in present and song not in failed):
+                    manifest['songs'].setdefault(song, old['songs'][song])
+        save_manifest(save_folder, manifest)
+
+    if cache_hits or cache_misses:
+        print("Strumming pattern cache: {} hits, {} misses".format(cache_hits, cache_misses))
+    print("Preprocessed {} songs ({} unchanged, {} failed)".format(
+        len(todo) - len(failed), len(songs) - len(todo), len(failed)))
+    for song in sorted(failed):
+        print("  {}: {}".format(song, failed[song]))
+
+    return failed
+
+INDEX_NAME = 'songs_index.tex'
+INCLUDEONLY_NAME = 'songs_includeonly.tex'
+
+# which songs go to the songbook index (include/exclude) and which of them
+# are compiled in a partial build (only); all are song names or tags
+IndexOptions = collections.namedtuple('IndexOptions', ['include', 'exclude', 'only'],
+    defaults=[(), (), ()])
+
+def song_matches(song, meta, names):
+    ''' True if song (file name with or without `.txt`) or one of its tags is in names. '''
+    return song in names or song[:-len('.txt')] in names or any(tag in names for tag in meta.get('tags', ()))
+
+def title_key(title):
+    ''' Sort key ignoring case and diacritics (Á sorts with A, Š with S, ...). '''
+    import unicodedata
+    return ''.join(c for c in unicodedata.normalize('NFKD', title) if not unicodedata.combining(c)).casefold()
+
+def write_if_changed(location, text):
+    ''' Writes text into file unless it already contains it (keeps mtime for
+        make & co.). Returns True if the file was written. '''
+    try:
+        with open(location, 'r', encoding="utf-8") as f:
+            if f.read() == text:
+                return False
+    except OSError:
+        pass
+    with open(location, 'w', encoding="utf-8") as f:
+        f.write(text)
+    return True
+
+def write_songs_index(save_folder, index_options=IndexOptions()):
+    ''' Writes save_folder/songs_index.tex that \\includes all successfully
+        preprocessed songs selected by index_options, sorted by title. With
+        index_options.only, save_folder/songs_includeonly.tex restricts the
+        build to the matching songs by \\includeonly. Returns list of songs
+        in the index. '''
+    songs = load_manifest(save_folder)['songs']
+
+    selected = [song for song, meta in songs.items()
+        if (not index_options.include or song_matches(song, meta, index_options.include))
+        and not song_matches(song, meta, index_options.exclude)]
+    selected.sort(key=lambda song: (title_key(songs[song].get('title') or song), song))
+
+    # \include{x} reads x.tex and starts a new page before and after
+    index = ['% generated by pre.py, do not edit\n']
+    index.extend('\\include{{{}/{}}}\n'.format(save_folder, song) for song in selected)
+    write_if_changed(os.path.join(save_folder, INDEX_NAME), ''.join(index))
+
+    includeonly = os.path.join(save_folder, INCLUDEONLY_NAME)
+    if index_options.only:
+        only = [save_folder + '/' + song for song in selected if song_matches(song, songs[song], index_options.only)]
+        write_if_changed(includeonly, '\\includeonly{{{}}}\n'.format(','.join(only)))
+    elif os.path.exists(includeonly):
+        os.remove(includeonly)
+
+    return selected
+
+def compile_songbook(log_location='compile.log'):
+    ''' Compiles songbook.tex (with the precompiled preamble, see build.py), returns True on success. '''
+    import build
+    return build.compile_full(log_location)
+
+def song_snapshot(source_folder):
+    ''' Returns {song: (mtime, size)} of all songs in source_folder. '''
+    snapshot = {}
+    with os.scandir(source_folder) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt') and entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def source_snapshot(source):
+    ''' Same as song_snapshot, songs of a bundle are identified by (sha256, size). '''
+    if os.path.isdir(source):
+        return song_snapshot(source)
+    import bundle
+    return {song: (entry['sha256'], entry['size']) for song, entry in bundle.cached_bundle(source).index.items()}
+
+def poll_changes(source_folder, interval):
+    ''' Yields set of songs changed (or created/deleted) every `interval` seconds. '''
+    import time
+
+    before = song_snapshot(source_folder)
+    while True:
+        time.sleep(interval)
+        after = song_snapshot(source_folder)
+        yield {song for song in before.keys() | after.keys() if before.get(song) != after.get(song)}
+        before = after
+
+def watchdog_changes(source_folder, interval):
+    ''' Same as poll_changes, but driven by inotify (or its equivalent) via watchdog. '''
+    import queue
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    events = queue.Queue()
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            # reading the songs ourselves produces opened/closed events, ignore those
+            if event.is_directory or event.event_type not in ('created', 'modified', 'deleted', 'moved'):
+                return
+            for path in (event.src_path, getattr(event, 'dest_path', '')):
+                if path and path.endswith('.txt'):
+                    events.put(os.path.basename(path))
+
+    observer = Observer()
+    observer.schedule(Handler(), source_folder, recursive=False)
+    observer.start()
+    try:
+        while True:
+            changed = set()
+            try:
+                changed.add(events.get(timeout=interval))
+                while True:
+                    changed.add(events.get_nowait())
+            except queue.Empty:
+                pass
+            yield changed
+    finally:
+        observer.stop()
+        observer.join()
 
-for song in get_all_files_from('songs_txt'):
-    print("Preprocessing song {}".format(song))
-    split_song('songs_txt/'+song, 'songs_tex')
+def song_changes(source_folder, interval):
+    ''' Yields sets of changed songs, uses watchdog when it is installed and polls otherwise. '''
+    try:
+        import watchdog.observers
+    except ImportError:
+        return poll_changes(source_folder, interval)
+    return watchdog_changes(source_folder, interval)
+
+def watch(source_folder, save_folder, options, index_options=IndexOptions(), interval=0.5, debounce=1.0, compile=True):
+    ''' Re-renders songs whenever they are saved. The songbook is recompiled
+        once no song changed for `debounce` seconds, so a burst of saves
+        results in a single LaTeX run. Runs until interrupted. '''
+    import time
+
+    preprocess_songs(source_folder, save_folder, options, incremental=True)
+    write_songs_index(save_folder, index_options)
+    print("Watching {} for changes...".format(source_folder))
+
+    deadline = None
+    for changed in song_changes(source_folder, interval):
+        if changed:
+            preprocess_songs(source_folder, save_folder, options, incremental=True, only=changed)
+            write_songs_index(save_folder, index_options)
+            deadline = time.monotonic() + debounce
+
+        elif deadline is not None and time.monotonic() >= deadline:
+            deadline = None
+            if compile:
+                print("Compiling songbook...")
+                print("Done" if compile_songbook() else "Compilation failed, see compile.log")
+
+def add_song_options(parser):
+    ''' Adds arguments of all SongOptions to argparse parser. '''
+    parser.add_argument('--capo', action='store_true')
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--note', action='store_true')
+    parser.add_argument('--strumming', action='store_true')
+    parser.add_argument('--transpose', type=int, default=0, metavar='N',
+        help='transpose all chords by N semitones')
+    parser.add_argument('--normalize-capo', action='store_true',
+        help='transpose songs with a capo to the key they sound in without it')
+    parser.add_argument('--spelling', choices=['auto', 'sharp', 'flat'], default='auto',
+        help='accidentals of transposed chords (auto: by the key)')
+    parser.add_argument('--tab-size', type=int, default=1, metavar='N',
+        help='columns of a tab in chord lines and lyrics (1 by default)')
+
+def song_options(args):
+    ''' Returns SongOptions from arguments added by add_song_options. '''
+    return SongOptions(**{flag: getattr(args, flag) for flag in SongOptions._fields})
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Preprocessing...')
+
+    add_song_options(parser)
+    parser.add_argument('--incremental', action='store_true',
+        help='only reprocess songs changed since the last run')
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+        help='number of songs preprocessed in parallel')
+    parser.add_argument('--include', action='append', default=[], metavar='SONG|TAG',
+        help='put only these songs (or songs with these tags) into the songbook index')
+    parser.add_argument('--exclude', action='append', default=[], metavar='SONG|TAG',
+        help='leave these songs (or songs with these tags) out of the songbook index')
+    parser.add_argument('--only', action='append', default=[], metavar='SONG|TAG',
+        help='compile only these songs (partial build by \\includeonly)')
+    parser.add_argument('--profile', nargs='?', const='build/profile.json', metavar='FILE',
+        help='time every stage of every song, write the report to FILE (build/profile.json)')
+    parser.add_argument('--profile-dump', metavar='FILE',
+        help='also dump cProfile statistics of the conversion into FILE (implies --jobs 1)')
+    parser.add_argument('--watch', action='store_true',
+        help='keep re-rendering changed songs and recompiling the songbook')
+    parser.add_argument('--no-compile', action='store_true',
+        help='do not run pdflatex in watch mode')
+    parser.add_argument('--source', default='songs_txt',
+        help='folder with the songs or a bundle packed by bundle.py')
+
+    args = parser.parse_args(argv)
+    options = song_options(args)
+    index_options = IndexOptions(args.include, args.exclude, args.only)
+
+    make_sure_path_exists('songs_tex')
+
+    if args.watch:
+        if not os.path.isdir(args.source):
+            parser.error("--watch needs a folder of songs, not a bundle")
+        try:
+            watch(args.source, 'songs_tex', options, index_options, compile=not args.no_compile)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    profile = profiler = None
+    if args.profile or args.profile_dump:
+        profile = {}
+    if args.profile_dump:
+        import cProfile
+        profiler = cProfile.Profile()
+        args.jobs = 1
+
+    failed = preprocess_songs(args.source, 'songs_tex', options, incremental=args.incremental, jobs=args.jobs,
+        profile=profile, profiler=profiler)
+    write_songs_index('songs_tex', index_options)
+
+    if profile is not None:
+        import json
+        report = profile_report(profile)
+        print_profile(report)
+        location = args.profile or 'build/profile.json'
+        make_sure_path_exists(os.path.dirname(location) or '.')
+        with open(location, 'w', encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+        print("Profile written to {}".format(location))
+    if profiler is not None:
+        profiler.dump_stats(args.profile_dump)
+        print("cProfile statistics written to {} (see python -m pstats)".format(args.profile_dump))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
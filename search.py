@@ -0,0 +1,222 @@
+''' search.py finds songs by words of their lyrics, title and artist, or by
+    the chords they use, through an inverted index kept on disk '''
+
+import os
+import re
+import sys
+import json
+import argparse
+import unicodedata
+import collections
+
+import pre
+
+INDEX_LOCATION = os.path.join('build', 'search_index.json')
+
+# bump whenever the indexed data of a song changes, forces a full rebuild
+INDEX_VERSION = 1
+
+WORD_RE = re.compile(r'\w+')
+
+def fold(text):
+    ''' Lowercases text and strips diacritics (`Píseň` -> `pisen`), so that
+        queries can be typed without them. '''
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c)).casefold()
+
+def words(text):
+    ''' Returns folded words of text. '''
+    return WORD_RE.findall(fold(text))
+
+def song_entry(song, stat):
+    ''' Returns the index entry of song parsed by pre.parse_song. '''
+    meta = pre.song_meta(song)
+    tokens = set(words(meta['title'])) | set(words(meta['by']))
+    for section in song.sections:
+        if section.kind in (pre.MIXED, pre.TEXT):
+            for line in section.lines:
+                tokens.update(words(line.text))
+    return {'stat': list(stat), 'title': meta['title'], 'by': meta['by'],
+        'words': sorted(tokens), 'chords': meta['chords']}
+
+def empty_index():
+    return {'version': INDEX_VERSION, 'songs': {}, 'failed': {}, 'words': {}, 'chords': {}}
+
+def load_index(location=INDEX_LOCATION):
+    ''' Loads the index, returns an empty one if it is missing, broken or outdated. '''
+    try:
+        with open(location, 'r', encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return empty_index()
+    if index.get('version') != INDEX_VERSION:
+        return empty_index()
+    return index
+
+def save_index(index, location=INDEX_LOCATION):
+    ''' Atomically replaces the index on disk (see pre.save_manifest). '''
+    pre.make_sure_path_exists(os.path.dirname(location) or '.')
+    with open(location + '.tmp', 'w', encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(location + '.tmp', location)
+
+def remove_postings(index, song):
+    entry = index['songs'].pop(song)
+    for field in ('words', 'chords'):
+        for token in entry[field]:
+            postings = index[field][token]
+            postings.remove(song)
+            if not postings:
+                del index[field][token]
+
+def add_postings(index, song, entry):
+    index['songs'][song] = entry
+    for field in ('words', 'chords'):
+        for token in entry[field]:
+            index[field].setdefault(token, []).append(song)
+
+def update_index(index, source_folder):
+    ''' Re-indexes songs of source_folder (or a bundle) added or changed (by
+        pre.source_snapshot) since the last update and drops deleted ones.
+        Songs that fail to parse are remembered (with the error message) until
+        they change. Returns the number of re-indexed and removed songs. '''
+    snapshot = pre.source_snapshot(source_folder)
+    updated = 0
+    for song in set(index['songs']) - set(snapshot):
+        remove_postings(index, song)
+        updated += 1
+    for song in set(index['failed']) - set(snapshot):
+        del index['failed'][song]
+        updated += 1
+
+    for song, stat in sorted(snapshot.items()):
+        entry = index['songs'].get(song) or index['failed'].get(song)
+        if entry is not None and tuple(entry['stat']) == stat:
+            continue
+        if song in index['songs']:
+            remove_postings(index, song)
+        index['failed'].pop(song, None)
+        updated += 1
+        try:
+            parsed = pre.parse_song(pre.read_source_song(source_folder, song))
+        except Exception as e:
+            index['failed'][song] = {'stat': list(stat), 'error': '{}: {}'.format(type(e).__name__, e)}
+            continue
+        add_postings(index, song, song_entry(parsed, stat))
+    return updated
+
+def find_words(index, query):
+    ''' Returns set of songs containing all words of query in their lyrics,
+        title or artist. A word ending with `*` matches any word starting with it. '''
+    result = None
+    for term in query.split():
+        for word in words(term):
+            if term.endswith('*') and term.rstrip('*').endswith(word):
+                songs = {song for token, postings in index['words'].items() if token.startswith(word) for song in postings}
+            else:
+                songs = set(index['words'].get(word, ()))
+            result = songs if result is None else result & songs
+    return result if result is not None else set(index['songs'])
+
+def query_chords(chords):
+    ''' Converts chords typed by the user to the names used in the index (see pre.chord_names). '''
+    return set(pre.chord_names(chords))
+
+# chord sets of all songs as bitmasks over the vocabulary of all used chords:
+# bit i of a mask is set if the song uses vocabulary[i]
+ChordMasks = collections.namedtuple('ChordMasks', ['vocabulary', 'bits', 'songs', 'masks'])
+
+def chord_masks(index):
+    ''' Returns ChordMasks of all songs in index, the most used chords get the lowest bits. '''
+    vocabulary = sorted(index['chords'], key=lambda chord: (-len(index['chords'][chord]), chord))
+    bits = {chord: 1 << i for i, chord in enumerate(vocabulary)}
+    songs = sorted(index['songs'])
+    masks = [sum(bits[chord] for chord in set(index['songs'][song]['chords'])) for song in songs]
+    return ChordMasks(vocabulary, bits, songs, masks)
+
+def chords_mask(chord_sets, chords):
+    ''' Returns bitmask of chords (typed by the user), chords used by no song are left out. '''
+    return sum(chord_sets.bits.get(chord, 0) for chord in query_chords(chords))
+
+def playable_with(chord_sets, chords):
+    ''' Returns set of songs that use only the given chords. '''
+    unknown = ~chords_mask(chord_sets, chords)
+    return {song for song, mask in zip(chord_sets.songs, chord_sets.masks) if not mask & unknown}
+
+def suggest_chords(chord_sets, chords, count=1):
+    ''' Greedily picks `count` chords to learn next: each one makes the most
+        songs playable together with the known chords and the chords picked
+        before it. If no song is a single chord away, the chord missing in
+        the most songs is picked. Returns list of (chord, number of songs
+        playable after learning it). '''
+    known = chords_mask(chord_sets, chords)
+    suggestions = []
+    for _ in range(count):
+        unlocked = collections.Counter()
+        missing_in = collections.Counter()
+        for mask in chord_sets.masks:
+            missing = mask & ~known
+            if missing and not missing & (missing - 1):
+                unlocked[missing] += 1
+            elif missing and not unlocked:
+                while missing:
+                    bit = missing & -missing
+                    missing_in[bit] += 1
+                    missing ^= bit
+        best = (unlocked or missing_in).most_common(1)
+        if not best:
+            break
+        known |= best[0][0]
+        chord = chord_sets.vocabulary[best[0][0].bit_length() - 1]
+        suggestions.append((chord, sum(1 for mask in chord_sets.masks if not mask & ~known)))
+    return suggestions
+
+def using_chords(index, chords):
+    ''' Returns set of songs that use all the given chords. '''
+    result = set(index['songs'])
+    for chord in query_chords(chords):
+        result &= set(index['chords'].get(chord, ()))
+    return result
+
+def sorted_songs(index, songs):
+    return sorted(songs, key=lambda song: (pre.title_key(index['songs'][song]['title'] or song), song))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Searches songs by lyrics, title, artist and chords.')
+    parser.add_argument('query', nargs='*',
+        help='words of lyrics, title or artist (without diacritics, `word*` for prefixes)')
+    parser.add_argument('--playable-with', nargs='+', default=[], metavar='CHORD',
+        help='only songs that use no other chords than these')
+    parser.add_argument('--suggest', type=int, default=0, metavar='N',
+        help='suggest N chords to learn next (to those given by --playable-with)')
+    parser.add_argument('--using', nargs='+', default=[], metavar='CHORD',
+        help='only songs that use all these chords')
+    parser.add_argument('--source', default='songs_txt',
+        help='folder with the songs or a bundle packed by bundle.py')
+    parser.add_argument('--index', default=INDEX_LOCATION)
+    args = parser.parse_args(argv)
+
+    index = load_index(args.index)
+    if update_index(index, args.source):
+        save_index(index, args.index)
+    for song, entry in sorted(index['failed'].items()):
+        print("Not indexed {}: {}".format(song, entry['error']), file=sys.stderr)
+
+    chord_sets = chord_masks(index)
+    if args.suggest:
+        for chord, playable in suggest_chords(chord_sets, args.playable_with, args.suggest):
+            print("{} ({} playable songs)".format(chord.replace('+', '#'), playable))
+        return 0
+
+    songs = find_words(index, ' '.join(args.query))
+    if args.playable_with:
+        songs &= playable_with(chord_sets, args.playable_with)
+    if args.using:
+        songs &= using_chords(index, args.using)
+
+    for song in sorted_songs(index, songs):
+        entry = index['songs'][song]
+        print("{} ({}) -- {}".format(entry['title'], entry['by'], song))
+    return 0 if songs else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
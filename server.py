@@ -0,0 +1,406 @@
+''' server.py serves songs rendered into TeX, HTML and PDF over HTTP (asyncio,
+    no dependencies), so the web front end does not run pre.py and pdflatex
+    for every request '''
+
+import io
+import os
+import re
+import sys
+import json
+import shutil
+import zipfile
+import asyncio
+import hashlib
+import argparse
+import functools
+import threading
+import traceback
+import collections
+import urllib.parse
+import concurrent.futures
+
+import pre
+import web
+import build
+import editions
+
+SERVER_FOLDER = os.path.join(build.BUILD_FOLDER, 'server')
+
+SONG_PATH_RE = re.compile(r'/songs/(\w[\w.-]*)\.(txt|tex|html|md|pdf)')
+
+CONTENT_TYPES = {
+    'txt': 'text/plain; charset=utf-8',
+    'tex': 'application/x-tex; charset=utf-8',
+    'html': 'text/html; charset=utf-8',
+    'md': 'text/markdown; charset=utf-8',
+    'json': 'application/json',
+    'pdf': 'application/pdf',
+    'zip': 'application/zip',
+}
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+
+Response = collections.namedtuple('Response', ['status', 'content_type', 'body'])
+
+def text_response(text, kind='txt', status=200):
+    return Response(status, CONTENT_TYPES[kind], text.encode('utf-8'))
+
+def json_response(data):
+    return Response(200, CONTENT_TYPES['json'], json.dumps(data, ensure_ascii=False, indent=1).encode('utf-8'))
+
+def error_response(status, message):
+    return text_response(message + '\n', status=status)
+
+def server_state(source, cache_size=256, jobs=2, use_format=True, max_pdfs=64):
+    ''' Returns the state shared by all requests: the LRU cache of parsed
+        songs {(song, tab_size): (stat, Song or None, error)} with the lock guarding it,
+        the pool of `jobs` threads running LaTeX, the compiles in progress
+        {key: future}, the LRU of compiled build/server/<key> folders (the
+        existing ones ordered by their mtime) and counters. '''
+    state = {
+        'source': source,
+        'cache': collections.OrderedDict(),
+        'cache_size': cache_size,
+        'lock': threading.Lock(),
+        'pool': concurrent.futures.ThreadPoolExecutor(max_workers=jobs),
+        'pending': {},
+        'pdfs': collections.OrderedDict(),
+        'max_pdfs': max_pdfs,
+        'use_format': use_format,
+        'stats': collections.Counter(),
+    }
+    if os.path.isdir(SERVER_FOLDER):
+        folders = [entry for entry in os.scandir(SERVER_FOLDER) if entry.is_dir()]
+        for entry in sorted(folders, key=lambda entry: entry.stat().st_mtime):
+            keep_pdf(state, entry.name)
+    return state
+
+def song_stat(source, song):
+    ''' Returns (mtime, size) of song in a folder or (sha256, size) in a bundle,
+        raises KeyError if there is no such song. '''
+    if os.path.isdir(source):
+        try:
+            stat = os.stat(os.path.join(source, song))
+        except FileNotFoundError:
+            raise KeyError(song)
+        return (stat.st_mtime_ns, stat.st_size)
+    import bundle
+    entry = bundle.cached_bundle(source).index[song]
+    return (entry['sha256'], entry['size'])
+
+def cached_song(state, song, tab_size=1):
+    ''' Returns song parsed by pre.parse_song, parsed again only when its file
+        changed. Raises KeyError for unknown songs and ValueError (with the
+        parse error) for songs that do not parse. Called from worker threads,
+        the lock is held only around the cache, not while parsing. '''
+    stat = song_stat(state['source'], song)
+    cache = state['cache']
+    key = (song, tab_size)
+    with state['lock']:
+        entry = cache.get(key)
+        if entry is not None and entry[0] == stat:
+            state['stats']['cache hits'] += 1
+            cache.move_to_end(key)
+        else:
+            state['stats']['cache misses'] += 1
+            entry = None
+    if entry is None:
+        try:
+            entry = (stat, pre.parse_song(pre.read_source_song(state['source'], song), tab_size), None)
+        except Exception as e:
+            entry = (stat, None, '{}: {}'.format(type(e).__name__, e))
+        with state['lock']:
+            cache[key] = entry
+            cache.move_to_end(key)
+            while len(cache) > state['cache_size']:
+                cache.popitem(last=False)
+    if entry[2]:
+        raise ValueError(entry[2])
+    return entry[1]
+
+def all_songs(state, tab_size=1):
+    ''' Returns ({song: Song}, {song: error message}) of all songs of the source. '''
+    songs = {}
+    failed = {}
+    for song in pre.source_songs(state['source']):
+        try:
+            songs[song] = cached_song(state, song, tab_size)
+        except (KeyError, ValueError) as e:
+            failed[song] = str(e)
+    return songs, failed
+
+def request_options(query):
+    ''' Returns (SongOptions, instrument) from query parameters, flags are set
+        by their presence, e.g. `?capo&strumming&transpose=2&instrument=guitar`.
+        Raises ValueError for unknown or invalid parameters. '''
+    params = {name.replace('-', '_'): values[-1]
+        for name, values in urllib.parse.parse_qs(query, keep_blank_values=True).items()}
+    unknown = set(params) - set(pre.SongOptions._fields) - {'instrument'}
+    if unknown:
+        raise ValueError("unknown parameters: {}".format(', '.join(sorted(unknown))))
+
+    values = {}
+    for flag, default in pre.SongOptions._field_defaults.items():
+        if flag not in params:
+            continue
+        if flag in ('transpose', 'tab_size'):
+            values[flag] = int(params[flag])
+        elif flag == 'spelling':
+            if params[flag] not in ('auto', 'sharp', 'flat'):
+                raise ValueError("spelling is one of auto, sharp, flat")
+            values[flag] = params[flag]
+        else:
+            values[flag] = params[flag] not in ('0', 'false', 'no')
+    for flag in ('capo', 'compact', 'note', 'strumming'):
+        values.setdefault(flag, flag in params)
+    if values.get('tab_size', 1) < 1:
+        raise ValueError("tab_size is at least 1")
+
+    instrument = params.get('instrument', 'ukulele')
+    if instrument not in build.INSTRUMENTS:
+        raise ValueError("instrument is one of {}".format(', '.join(build.INSTRUMENTS)))
+    return pre.SongOptions(**values), instrument
+
+def book_songs(songs, options):
+    ''' Returns [(song, re-keyed Song)] of songs ({song: Song}) sorted by title. '''
+    rekeyed = {song: pre.rekey_song(parsed, options) for song, parsed in songs.items()}
+    metas = {song: pre.song_meta(parsed) for song, parsed in rekeyed.items()}
+    order = editions.edition_songs({'index_options': pre.IndexOptions()}, metas)
+    return [(song, rekeyed[song]) for song in order]
+
+def source_book(state, options):
+    ''' Returns book_songs of all songs that parse. '''
+    songs, _ = all_songs(state, options.tab_size)
+    return book_songs(songs, options)
+
+def book_document(songs, instrument, folder):
+    ''' Returns songbook.tex inputting songs from folder (see editions.edition_document). '''
+    with open('songbook.tex', 'r', encoding="utf-8", newline='') as f:
+        main_txt = f.read()
+    return editions.edition_document(main_txt, {'instrument': instrument}, songs, folder)
+
+def book_zip(songs, options, instrument):
+    ''' Returns zip archive with songbook.tex, the rendered songs ([(song,
+        Song)]) and the chord definitions, compilable on its own. '''
+    document = book_document([song for song, _ in songs], instrument, 'songs')
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('songbook.tex', document)
+        for song, parsed in songs:
+            archive.writestr('songs/' + song + '.tex', pre.render_song(parsed, options))
+        for location in build.PREAMBLE_INPUTS:
+            archive.write(location)
+    return buffer.getvalue()
+
+def book_response(state, path, options, instrument):
+    ''' Returns Response with the whole songbook (HTML or zip) or the list of songs. '''
+    songs, failed = all_songs(state, options.tab_size)
+    if path == '/songs':
+        return json_response({'songs': {song: pre.song_meta(parsed) for song, parsed in sorted(songs.items())}, 'failed': failed})
+    if path == '/book.zip':
+        return Response(200, CONTENT_TYPES['zip'], book_zip(book_songs(songs, options), options, instrument))
+    return text_response(web.render_songbook_html(dict(book_songs(songs, options)), options), 'html')
+
+def pdf_sources(songs, options, instrument):
+    ''' Returns (key, [(song, TeX)]) of songs ([(song, Song)]), the key is
+        the hash of the rendered songs and names their build/server folder. '''
+    rendered = [(song, pre.render_song(parsed, options)) for song, parsed in songs]
+    digest = hashlib.sha256(instrument.encode('utf-8'))
+    for song, tex in rendered:
+        digest.update(b'\0' + song.encode('utf-8') + b'\0' + tex.encode('utf-8'))
+    return digest.hexdigest()[:16], rendered
+
+def compile_pdf(key, rendered, instrument, fmt):
+    ''' Writes the songs ([(song, TeX)]) and their document into build/server/<key>
+        and compiles it (see editions.compile_edition). Runs in the worker
+        pool. Returns the PDF, None if the compilation failed. '''
+    folder = os.path.join(SERVER_FOLDER, key)
+    songs_folder = os.path.join(folder, 'songs')
+    pre.make_sure_path_exists(songs_folder)
+    locations = []
+    for song, tex in rendered:
+        locations.append(os.path.join(songs_folder, song + '.tex'))
+        pre.write_if_changed(locations[-1], tex)
+    tex_location = os.path.join(folder, 'songbook.tex')
+    pre.write_if_changed(tex_location, book_document([song for song, _ in rendered], instrument, songs_folder))
+    if not editions.compile_edition(tex_location, locations, fmt):
+        return None
+    with open(os.path.join(folder, 'songbook.pdf'), 'rb') as f:
+        return f.read()
+
+def keep_pdf(state, key):
+    ''' Marks build/server/<key> as the most recently used folder and deletes
+        the least recently used ones over max_pdfs, except those compiling. '''
+    pdfs = state['pdfs']
+    pdfs[key] = True
+    pdfs.move_to_end(key)
+    for old in list(pdfs):
+        if len(pdfs) <= state['max_pdfs']:
+            break
+        if old == key or old in state['pending']:
+            continue
+        del pdfs[old]
+        shutil.rmtree(os.path.join(SERVER_FOLDER, old), ignore_errors=True)
+        state['stats']['evicted pdfs'] += 1
+
+def coalesced(state, key, function, *args):
+    ''' Runs function(*args) in the worker pool, unless a call with the same
+        key is still running, in which case its result is shared. Returns an
+        awaitable of the result. '''
+    pending = state['pending'].get(key)
+    if pending is None:
+        state['stats']['compiles'] += 1
+        pending = asyncio.get_running_loop().run_in_executor(state['pool'], function, *args)
+        state['pending'][key] = pending
+        pending.add_done_callback(lambda _: state['pending'].pop(key, None))
+    else:
+        state['stats']['coalesced'] += 1
+    return asyncio.shield(pending)
+
+async def off_loop(function, *args):
+    ''' Runs function(*args) (parsing and rendering) in the default executor,
+        so it does not block the event loop. '''
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+async def pdf_response(state, songs, options, instrument):
+    ''' Compiles songs ([(song, Song)]) into a PDF. Concurrent requests for
+        the same songs (with the same options) share a single compilation. '''
+    key, rendered = await off_loop(pdf_sources, songs, options, instrument)
+
+    fmt = None
+    if state['use_format']:
+        fmt = await coalesced(state, 'format', build.build_format)
+    try:
+        pdf = await coalesced(state, key, compile_pdf, key, rendered, instrument, fmt)
+    finally:
+        keep_pdf(state, key)
+    if pdf is None:
+        return error_response(500, "Compilation failed, see {}".format(os.path.join(SERVER_FOLDER, key, 'songbook.log')))
+    return Response(200, CONTENT_TYPES['pdf'], pdf)
+
+def rekeyed_song(state, song, options):
+    return pre.rekey_song(cached_song(state, song, options.tab_size), options)
+
+def song_document(state, song, kind, options):
+    ''' Returns Response with song rendered into kind (txt, tex, md or html). '''
+    if kind == 'txt':
+        song_stat(state['source'], song)
+        return text_response(pre.read_source_song(state['source'], song))
+    parsed = rekeyed_song(state, song, options)
+    if kind == 'tex':
+        return text_response(pre.render_song(parsed, options), kind)
+    if kind == 'md':
+        return text_response(web.render_song_markdown(parsed, options), kind)
+    title = pre.song_meta(parsed)['title'] or web.slug(song)
+    return text_response(web.html_page(title, web.render_song_html(parsed, options)), kind)
+
+async def song_response(state, song, kind, options, instrument):
+    if kind != 'pdf':
+        return await off_loop(song_document, state, song, kind, options)
+    parsed = await off_loop(rekeyed_song, state, song, options)
+    return await pdf_response(state, [(song, parsed)], options, instrument)
+
+async def respond(state, target):
+    ''' Returns Response to GET of target (path with query). '''
+    path, _, query = target.partition('?')
+    path = urllib.parse.unquote(path)
+    try:
+        options, instrument = request_options(query)
+    except ValueError as e:
+        return error_response(400, str(e))
+
+    if path in ('/', '/book.html', '/book.zip', '/songs'):
+        return await off_loop(book_response, state, path, options, instrument)
+    if path == '/book.pdf':
+        return await pdf_response(state, await off_loop(source_book, state, options), options, instrument)
+    if path == '/stats':
+        return json_response(dict(state['stats'], **{'cached songs': len(state['cache']),
+            'compiling': len(state['pending']), 'kept pdfs': len(state['pdfs'])}))
+
+    m = SONG_PATH_RE.fullmatch(path)
+    if not m:
+        return error_response(404, "Not found: {}".format(path))
+    song, kind = m.group(1) + '.txt', m.group(2)
+    try:
+        return await song_response(state, song, kind, options, instrument)
+    except KeyError:
+        return error_response(404, "No song {}".format(song))
+    except ValueError as e:
+        return error_response(422, str(e))
+
+async def handle(state, reader, writer):
+    ''' Serves one HTTP/1.1 request per connection. '''
+    method = 'GET'
+    try:
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+        except ValueError:
+            response = error_response(400, "Malformed request")
+        else:
+            state['stats']['requests'] += 1
+            if method not in ('GET', 'HEAD'):
+                response = error_response(405, "Only GET and HEAD are supported")
+            else:
+                response = await respond(state, target)
+    except Exception:
+        traceback.print_exc()
+        response = error_response(500, "Internal error, see the server log")
+
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+        response.status, REASONS[response.status], response.content_type, len(response.body))
+    writer.write(head.encode('latin-1'))
+    if method != 'HEAD':
+        writer.write(response.body)
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+async def fetch(host, port, target, method='GET'):
+    ''' Minimal client for trying out the server locally, returns (status, body). '''
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n\r\n'.format(method, target, host).encode('latin-1'))
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    head, _, body = data.partition(b'\r\n\r\n')
+    return int(head.split(b' ', 2)[1]), body
+
+async def serve(state, host, port):
+    server = await asyncio.start_server(functools.partial(handle, state), host, port)
+    host, port = server.sockets[0].getsockname()[:2]
+    print("Serving {} on http://{}:{}/".format(state['source'], host, port))
+    async with server:
+        await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves songs rendered into TeX, HTML and PDF over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--source', default='songs_txt',
+        help='folder with the songs or a bundle packed by bundle.py')
+    parser.add_argument('--jobs', '-j', type=int, default=2, metavar='N',
+        help='number of parallel LaTeX compilations')
+    parser.add_argument('--cache-size', type=int, default=256, metavar='N',
+        help='number of parsed songs kept in memory')
+    parser.add_argument('--max-pdfs', type=int, default=64, metavar='N',
+        help='number of compiled PDFs kept in build/server')
+    parser.add_argument('--no-format', action='store_true',
+        help='do not precompile the preamble into a format')
+    args = parser.parse_args(argv)
+
+    state = server_state(args.source, args.cache_size, args.jobs, not args.no_format, args.max_pdfs)
+    try:
+        asyncio.run(serve(state, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state['pool'].shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
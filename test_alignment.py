@@ -0,0 +1,148 @@
+''' test_alignment.py checks the placement of chords above the lyrics
+    (pre.align_chords, pre.inject_lines) against the line by line conversion
+    used before sections were aligned at once, and by display columns for
+    lines with tabs, wide and combining characters.
+    Run by `python3 -m pytest` or `python3 -m unittest`. '''
+
+import re
+import unittest
+
+import pre
+
+def reference_chord_positions(chordline):
+    ''' chord_positions before the batched alignment: chord lines index the lyrics directly. '''
+    chords = chordline.split()
+    start = 0
+    positions = []
+    for c in chords:
+        start = chordline.index(c, start)
+        positions.append(start)
+        start += len(c)
+    return chords, positions
+
+def reference_inject_line(line, chords, positions):
+    ''' inject_line before the batched alignment. '''
+    injected_line = ""
+    last = 0
+    for i in range(len(chords)):
+        if re.match(r"\(.*\)", chords[i]):
+            injected_line += chords[i]
+        else:
+            if len(line) >= positions[i]:
+                injected_line += line[last:positions[i]]
+            else:
+                if last < len(line):
+                    injected_line += line[last:positions[i]]
+                    N = 4 - (len(line) - last) + 2
+                else:
+                    N = 4
+                injected_line += "\\phantom{" + "N"*N + "}"
+
+            injected_line += "\\chord{" + chords[i] + "}"
+            last = positions[i]
+    injected_line += line[last:]
+    return injected_line.replace('#', '\\#')
+
+def reference_section(chordlines, texts):
+    ''' TeX of a section with chords above the lyrics as it was rendered line
+        by line (tabs are turned into `~` like spaces now). '''
+    return ''.join(reference_inject_line(text, *reference_chord_positions(chordline)).replace(' ', '~').replace('\t', '~') + '\\\\\n'
+        for chordline, text in zip(chordlines, texts))
+
+def mixed_sections(txt):
+    ''' Yields (chord lines, lyrics) of every section with chords above the
+        lyrics, split the same way as by pre.parse_song. '''
+    parts = pre.SONG_PARTS_RE.split(txt)
+    if parts[0] == '':
+        parts.pop(0)
+    for tag, data in zip(parts[::2], parts[1::2]):
+        name, suffix = pre.TAG_RE.fullmatch(tag.strip()).groups()
+        if not suffix and name.lower() != 'info':
+            lines = [s for s in data.splitlines() if s]
+            yield lines[::2], lines[1::2]
+
+class CorpusTest(unittest.TestCase):
+    ''' With the default tab_size, every song of songs_txt renders as before. '''
+
+    def test_songs_txt(self):
+        compared = 0
+        for song in sorted(pre.source_songs('songs_txt')):
+            txt = pre.read_source_song('songs_txt', song)
+            try:
+                parsed = pre.parse_song(txt)
+            except ValueError:
+                continue
+            sections = [section for section in parsed.sections if section.kind == pre.MIXED]
+            for section, (chordlines, texts) in zip(sections, mixed_sections(txt)):
+                with self.subTest(song=song, section=section.name):
+                    self.assertEqual([(line.chords, line.positions) for line in section.lines],
+                        [reference_chord_positions(chordline) for chordline in chordlines])
+                    self.assertEqual(pre.inject_lines(section.lines), reference_section(chordlines, texts))
+                compared += 1
+        self.assertGreater(compared, 0)
+
+    def test_tabs_in_songs_txt(self):
+        # tears-in-heaven has tabs in its chord lines
+        txt = pre.read_source_song('songs_txt', 'tears-in-heaven.txt')
+        self.assertIn('\t', txt)
+        sections = [section for section in pre.parse_song(txt).sections if section.kind == pre.MIXED]
+        self.assertEqual([pre.inject_lines(section.lines) for section in sections],
+            [reference_section(chordlines, texts) for chordlines, texts in mixed_sections(txt)])
+
+class ColumnsTest(unittest.TestCase):
+
+    def test_tab(self):
+        self.assertEqual(pre.line_columns('ab\tcd'), ([0, 1, 2, 3, 4], 5))
+        self.assertEqual(pre.line_columns('ab\tcd', 8), ([0, 1, 2, 8, 9], 10))
+        self.assertEqual(pre.line_columns('\t\tx', 4), ([0, 4, 8], 9))
+
+    def test_wide(self):
+        self.assertEqual(pre.line_columns('你好world'), ([0, 2, 4, 5, 6, 7, 8], 9))
+
+    def test_combining(self):
+        # `ů` written as `u` and a combining ring, `č` as `c` and a caron
+        self.assertEqual(pre.line_columns('ku\u030an\u030c'), ([0, 1, 1, 2, 2], 3))
+
+    def test_past_the_end(self):
+        self.assertEqual(pre.column_index('你好', 6), 4)
+        self.assertEqual(pre.column_index('ab', 6), 6)
+
+class AlignTest(unittest.TestCase):
+
+    def test_tab_one_column(self):
+        self.assertEqual(pre.align_chords(['\tG  C'], ['ab\tcdef']), [(['G', 'C'], [1, 4])])
+
+    def test_tab_size(self):
+        self.assertEqual(pre.align_chords(['\tG  C'], ['ab\tcdef'], 8), [(['G', 'C'], [3, 6])])
+        self.assertEqual(pre.align_chords(['        G'], ['ab\tcd'], 8), [(['G'], [3])])
+
+    def test_wide(self):
+        self.assertEqual(pre.align_chords(['  G   C'], ['你好world']), [(['G', 'C'], [1, 4])])
+        self.assertEqual(pre.inject_lines([pre.Line('你好world', ['G', 'C'], [1, 4])]),
+            '你\\chord{G}好wo\\chord{C}rld\\\\\n')
+
+    def test_combining(self):
+        self.assertEqual(pre.align_chords(['  G  C'], ['ku\u030an\u030c je']), [(['G', 'C'], [3, 7])])
+
+    def test_narrow_section(self):
+        # Latin letters with diacritics take one column each
+        chordlines = ['G    C', 'Am (x2)']
+        texts = ['Kůň úpěl', 'Ódy']
+        self.assertEqual(pre.align_chords(chordlines, texts), [reference_chord_positions(line) for line in chordlines])
+
+class ParseTest(unittest.TestCase):
+
+    TXT = '[Info]\nTitle: Tabs\n\n[Verse]\n\tG\nab\tcd\n'
+
+    def test_parse_song(self):
+        self.assertEqual(pre.parse_song(self.TXT).sections[1].lines, [pre.Line('ab\tcd', ['G'], [1])])
+        self.assertEqual(pre.parse_song(self.TXT, 8).sections[1].lines, [pre.Line('ab\tcd', ['G'], [3])])
+
+    def test_tabs_in_tex(self):
+        tex = pre.song_to_tex(self.TXT, pre.SongOptions(tab_size=8))
+        self.assertIn('ab~\\chord{G}cd\\\\', tex)
+        self.assertNotIn('\t', tex)
+        self.assertNotIn('\t', pre.song_to_tex('[Verse&]\nab\tcd\n', pre.SongOptions()))
+
+if __name__ == '__main__':
+    unittest.main()
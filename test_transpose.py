@@ -0,0 +1,41 @@
+''' test_transpose.py checks that transposing (pre.transpose_chord,
+    pre.rekey_song) moves only chords, never words on chord lines.
+    Run by `python3 -m pytest` or `python3 -m unittest`. '''
+
+import unittest
+
+import pre
+
+class TransposeChordTest(unittest.TestCase):
+
+    def test_chords(self):
+        self.assertEqual(pre.transpose_chord('Am7', 2), 'Bm7')
+        self.assertEqual(pre.transpose_chord('D/F#', 2), 'E/G#')
+        self.assertEqual(pre.transpose_chord('Asus4', 2), 'Bsus4')
+        self.assertEqual(pre.transpose_chord('Bb', 2), 'C')
+        self.assertEqual(pre.transpose_chord('H7', 1), 'C7')
+        self.assertEqual(pre.transpose_chord('C', 1, flats=True), 'Db')
+
+    def test_compound_tokens(self):
+        self.assertEqual(pre.transpose_chord('C)(G', 2), 'D)(A')
+        self.assertEqual(pre.transpose_chord('(Am', 2), '(Bm')
+        self.assertEqual(pre.transpose_chord('G~Am~G~C', 2), 'A~Bm~A~D')
+
+    def test_no_chord(self):
+        self.assertEqual(pre.transpose_chord('N.C.', 2), 'N.C.')
+
+    def test_annotations(self):
+        for annotation in ('(Chorus)', '(All)', '(Capo)', '(x2)', '(Dohra)'):
+            with self.subTest(annotation=annotation):
+                self.assertEqual(pre.transpose_chord(annotation, 2), annotation)
+
+class RekeySongTest(unittest.TestCase):
+
+    TXT = '[Info]\nTitle: Test\n\n[Verse]\nC   N.C.  G (Chorus)\nLa la la la la la\n'
+
+    def test_rekey_song(self):
+        song = pre.rekey_song(pre.parse_song(self.TXT), pre.SongOptions(transpose=2))
+        self.assertEqual(song.sections[1].lines[0].chords, ['D', 'N.C.', 'A', '(Chorus)'])
+
+if __name__ == '__main__':
+    unittest.main()
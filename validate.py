@@ -0,0 +1,172 @@
+''' validate.py checks songs in the songs_txt format and reports every
+    problem with its file and line (usable as a pre-commit hook) '''
+
+import os
+import re
+import sys
+import argparse
+import collections
+
+import pre
+
+# line is 1-based, severity is ERROR (the song does not convert or loses
+# text) or WARNING (the song converts, but probably not as intended)
+Diagnostic = collections.namedtuple('Diagnostic', ['line', 'severity', 'message'])
+
+ERROR = 'error'
+WARNING = 'warning'
+
+INFO_KEYS = ('Title', 'By', 'Capo', 'Strumming', 'Note', 'Tags')
+
+# a line that is meant to be a tag, valid or not (but not `[: lyrics :]` repeats)
+TAG_LINE_RE = re.compile(r'\s*\[\w[^\]]*\]\s*')
+# tokens of chord lines that are only decoration (`|`, `-`, ...)
+DECORATION_RE = re.compile(r'\W+')
+
+def check_chords(number, chords, known_chords, diagnostics):
+    ''' Checks chords of a chord line (line `number`). '''
+    for token in pre.ANNOTATION_SPAN_RE.sub(' ', ' '.join(chords)).split():
+        if not DECORATION_RE.fullmatch(token) and pre.parse_chord(token) is None:
+            diagnostics.append(Diagnostic(number, WARNING, '`{}` is not a chord (lyrics on a chord line?)'.format(token)))
+    if known_chords is not None:
+        for chord in pre.chord_names(chords):
+            if chord not in known_chords and pre.parse_chord(chord.replace('+', '#')) is not None:
+                diagnostics.append(Diagnostic(number, WARNING, 'chord {} has no diagram'.format(chord.replace('+', '#'))))
+
+def check_info(lines, diagnostics):
+    keys = set()
+    for number, line in lines:
+        key, sep, value = line.partition(': ')
+        if not sep:
+            diagnostics.append(Diagnostic(number, WARNING, 'expected `Key: value` in [Info], ignored'))
+        elif key not in INFO_KEYS:
+            diagnostics.append(Diagnostic(number, WARNING, 'unknown [Info] key `{}`, ignored'.format(key)))
+        elif key == 'Strumming':
+            m = pre.STRUMMING_RE.match(value)
+            if m.end() != len(value):
+                diagnostics.append(Diagnostic(number, WARNING, 'strumming pattern may only contain `duxyz-` and a (note)'))
+            # pre.tikz_strumming draws every pattern by pairs of strokes (beat and `&`)
+            odd = [pattern for pattern in m.group(1).split() if len(pattern) % 2]
+            if odd:
+                diagnostics.append(Diagnostic(number, ERROR, 'strumming pattern of an odd length (a beat without its `&`): {}'.format(' '.join(odd))))
+        keys.add(key)
+    if 'Title' not in keys:
+        diagnostics.append(Diagnostic(lines[0][0] if lines else 1, WARNING, '[Info] without Title'))
+
+def check_mixed(tag, lines, known_chords, diagnostics):
+    if len(lines) % 2:
+        number, line = lines[-1]
+        diagnostics.append(Diagnostic(number, ERROR, 'chord line without lyrics in {}: {}'.format(
+            tag, line.strip() or '(the line contains only whitespace)')))
+    pairs = list(zip(lines[::2], lines[1::2]))
+    aligned = pre.align_chords([chordline for (_, chordline), _ in pairs], [text for _, (_, text) in pairs])
+    for ((number, chordline), (_, text)), (chords, positions) in zip(pairs, aligned):
+        check_chords(number, chords, known_chords, diagnostics)
+        past = [chord for chord, position in zip(chords, positions)
+            if position > len(text) and not pre.ANNOTATION_RE.match(chord)]
+        if past:
+            diagnostics.append(Diagnostic(number, WARNING,
+                'chords past the end of the lyrics ({} characters): {}'.format(len(text), ' '.join(past))))
+
+def check_section(tag, lines, known_chords, diagnostics):
+    ''' Checks lines [(line number, text)] of section starting with tag. '''
+    m = pre.TAG_RE.fullmatch(tag)
+    name, suffix = m.groups()
+    if name.lower() == 'info' and not suffix:
+        check_info(lines, diagnostics)
+    elif suffix == '*':
+        for number, line in lines:
+            check_chords(number, line.split(), known_chords, diagnostics)
+    elif not suffix:
+        check_mixed(tag, lines, known_chords, diagnostics)
+
+def song_sections(txt):
+    ''' Yields (tag, its line number, [(line number, line)]) of every section,
+        split exactly as by pre.parse_song (empty lines are skipped). '''
+    matches = list(pre.SONG_PARTS_RE.finditer(txt))
+    for m, following in zip(matches, matches[1:] + [None]):
+        data = txt[m.end():following.start() if following else len(txt)]
+        first = txt.count('\n', 0, m.end()) + 1
+        lines = [(number, line) for number, line in enumerate(data.splitlines(), first) if line]
+        yield m.group(1).strip(), txt.count('\n', 0, m.start()) + 1, lines
+
+def validate_song(txt, known_chords=None):
+    ''' Returns list of Diagnostics of annotated song text (see pre.parse_song),
+        in one pass over its sections, split the same way as by
+        pre.parse_song, so that every song it rejects gets an ERROR. Chords
+        are checked against the set known_chords (in the \\chordlist form, #
+        replaced by +) unless it is None. '''
+    diagnostics = []
+    first = pre.SONG_PARTS_RE.search(txt)
+    if first is None:
+        if txt.strip():
+            diagnostics.append(Diagnostic(1, ERROR, 'text outside of a valid section'))
+    elif first.start() > 0:
+        # pre.parse_song takes anything before the first tag for a tag
+        diagnostics.append(Diagnostic(1, ERROR, 'text (or empty lines) before the first tag'))
+
+    for tag, number, lines in song_sections(txt):
+        if not pre.TAG_RE.fullmatch(tag):
+            diagnostics.append(Diagnostic(number, ERROR, 'unidentified tag {}'.format(tag)))
+            continue
+        # lines that look like tags, but are taken for lyrics (`[Verse 2]`)
+        for line_number, line in lines:
+            if TAG_LINE_RE.fullmatch(line):
+                diagnostics.append(Diagnostic(line_number, ERROR, 'unidentified tag {}'.format(line.strip())))
+        check_section(tag, lines, known_chords, diagnostics)
+
+    # report every missing chord diagram only once per song
+    reported = set()
+    unique = []
+    for d in diagnostics:
+        if d.message.endswith('has no diagram'):
+            if d.message in reported:
+                continue
+            reported.add(d.message)
+        unique.append(d)
+
+    return sorted(unique, key=lambda d: d.line)
+
+def validate_files(locations, known_chords=None):
+    ''' Returns {file location: list of Diagnostics}. '''
+    results = {}
+    for location in locations:
+        try:
+            with open(location, 'r', encoding="utf-8") as f:
+                results[location] = validate_song(f.read(), known_chords)
+        except (OSError, UnicodeDecodeError) as e:
+            results[location] = [Diagnostic(1, ERROR, str(e))]
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks songs and reports problems with file and line.')
+    parser.add_argument('songs', nargs='*', metavar='FILE',
+        help='songs to check (all songs in --source by default)')
+    parser.add_argument('--source', default='songs_txt')
+    parser.add_argument('--instrument', default='ukulele', choices=['ukulele', 'guitar'],
+        help='report chords without a diagram in chords_<instrument>.tex')
+    parser.add_argument('--no-chords', action='store_true',
+        help='do not check chords against the chord definitions')
+    parser.add_argument('--strict', action='store_true',
+        help='fail also on warnings')
+    args = parser.parse_args(argv)
+
+    locations = args.songs or sorted(os.path.join(args.source, song) for song in pre.get_all_files_from(args.source))
+    known_chords = None
+    if not args.no_chords:
+        import build
+        known_chords = build.defined_chords(args.instrument)
+
+    counts = collections.Counter()
+    for location, diagnostics in validate_files(locations, known_chords).items():
+        for d in diagnostics:
+            print("{}:{}: {}: {}".format(location, d.line, d.severity, d.message))
+            counts[d.severity] += 1
+
+    print("{} songs checked, {} errors, {} warnings".format(len(locations), counts[ERROR], counts[WARNING]), file=sys.stderr)
+    if counts[ERROR] or (args.strict and counts[WARNING]):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
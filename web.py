@@ -0,0 +1,230 @@
+''' web.py renders songs parsed by pre.py into static HTML (or Markdown)
+    with chords above the lyrics, without running TeX '''
+
+import os
+import sys
+import html
+import argparse
+
+import pre
+
+HTML_FOLDER = 'songs_html'
+
+# same symbols as strumming_pattern uses in TeX
+STRUMMING_SYMBOLS = {'d': '↓', 'u': '↑', 'x': '×', 'y': '↓̸', 'z': '↑̸'}
+
+STYLE = '''
+body { font-family: sans-serif; max-width: 50em; margin: auto; padding: 1em; }
+nav li { list-style: none; }
+.by { font-style: italic; font-weight: normal; }
+.chordlist, .chord, .inline-chord { font-weight: bold; color: #a00; }
+.section-name { font-weight: bold; }
+.lines { font-family: sans-serif; }
+.line { white-space: pre; padding-top: 1.1em; line-height: 1.3; }
+.line.text { padding-top: 0; }
+.segment { position: relative; }
+.chord { position: absolute; left: 0; bottom: 1.2em; line-height: 1; }
+.tail { padding-right: 3em; }
+.strumming td { text-align: center; padding: 0 .2em; }
+.strumming tr + tr td { color: gray; font-size: small; }
+'''
+
+# filters the table of contents and songs of the whole songbook page
+SEARCH_SCRIPT = '''
+document.getElementById('search').addEventListener('input', function (e) {
+    var query = e.target.value.toLowerCase();
+    document.querySelectorAll('article').forEach(function (song) {
+        var hit = song.textContent.toLowerCase().indexOf(query) >= 0;
+        song.hidden = !hit;
+        document.querySelector('nav a[href="#' + song.id + '"]').parentNode.hidden = !hit;
+    });
+});
+'''
+
+def escape(text):
+    return html.escape(text, quote=True)
+
+def chord_label(name):
+    ''' Chord name for display (chord_names replaces `#` by `+` for TeX). '''
+    return name.replace('+', '#')
+
+def html_strumming(pattern):
+    ''' Renders strumming pattern (e.g. `d-du-udu`) as a table of arrows above beat numbers. '''
+    out = []
+    for bar in pattern.split():
+        n = len(bar) // 2
+        arrows = ''.join('<td>{}</td>'.format(STRUMMING_SYMBOLS.get(t, '')) for t in bar[:2 * n])
+        numbers = ''.join('<td>{}</td>'.format(i // 2 + 1 if i % 2 == 0 else '&amp;') for i in range(2 * n))
+        out.append('<table class="strumming"><tr>{}</tr><tr>{}</tr></table>'.format(arrows, numbers))
+    return ''.join(out)
+
+def html_info(song_info, options):
+    ''' Renders song header from info parsed by pre.parse_info (see pre.render_info). '''
+    out = ['<h1>{} <span class="by">({})</span></h1>\n'.format(escape(song_info['Title'] or ''), escape(song_info['By'] or ''))]
+    if song_info['Capo'] and options.capo:
+        out.append('<p><b>Capo</b>: {}</p>\n'.format(escape(song_info['Capo'])))
+    if options.strumming:
+        for pattern, note in song_info['Strumming']:
+            note = ' ' + escape(note) if note else ''
+            out.append('<div><b>Strumming</b>{}:\n{}</div>\n'.format(note, html_strumming(pattern)))
+    if song_info['Note'] and options.note:
+        out.append('<p><b>Note</b>: {}</p>\n'.format(escape(song_info['Note'])))
+    return ''.join(out)
+
+def html_segment(chord, text):
+    if chord is None:
+        return escape(text)
+    if not text:
+        # chord past the end of the line, see pre.inject_line
+        return '<span class="segment tail"><span class="chord">{}</span></span>'.format(escape(chord))
+    return '<span class="segment"><span class="chord">{}</span>{}</span>'.format(escape(chord), escape(text))
+
+def html_line(line, chords, positions):
+    ''' Puts chords above their positions in line, mirrors pre.inject_line:
+        (annotations) are kept inline right after the chord before them and
+        chords past the end of the line get some space of their own. '''
+    out = []
+    chord = None
+    annotations = ''
+    last = 0
+    for c, position in zip(chords, positions):
+        if pre.ANNOTATION_RE.match(c):
+            annotations += c
+            continue
+        out.append(html_segment(chord, annotations + line[last:position]))
+        chord = c
+        annotations = ''
+        last = min(position, len(line))
+    out.append(html_segment(chord, annotations + line[last:]))
+    return ''.join(out)
+
+def html_fragments(song, options):
+    ''' Yields HTML of song parsed by pre.parse_song piece by piece (see pre.tex_fragments). '''
+    for section in song.sections:
+
+        if section.kind == pre.INFO:
+            yield html_info(section.info, options)
+            yield '<p class="chordlist">{}</p>\n'.format(escape(', '.join(chord_label(c) for c in song.chords)))
+            continue
+
+        yield '<section>\n'
+        if options.compact:
+            yield '<span class="section-name">{}</span>: '.format(escape(section.name))
+        else:
+            yield '<div class="section-name">{}:</div>\n'.format(escape(section.name))
+
+        if section.kind == pre.CHORDS:
+            chords = (chord for line in section.lines for chord in line.chords)
+            yield '<span class="inline-chord">{}</span>\n'.format('&nbsp;&nbsp;'.join(escape(chord) for chord in chords))
+
+        else:
+            yield '<div class="lines">\n'
+            for line in section.lines:
+                if section.kind == pre.MIXED:
+                    yield '<div class="line">{}</div>\n'.format(html_line(line.text, line.chords, line.positions))
+                else:
+                    yield '<div class="line text">{}</div>\n'.format(escape(line.text))
+            yield '</div>\n'
+
+        yield '</section>\n'
+
+def render_song_html(song, options):
+    ''' Renders song parsed by pre.parse_song into a HTML fragment. '''
+    return ''.join(html_fragments(song, options))
+
+def html_page(title, body, script=''):
+    return ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>{}</title>\n'
+        '<style>{}</style>\n</head>\n<body>\n{}{}</body>\n</html>\n').format(
+            escape(title), STYLE, body, '<script>{}</script>\n'.format(script) if script else '')
+
+def slug(song):
+    ''' File name of the song without `.txt`, used for anchors and page names. '''
+    return song[:-len('.txt')] if song.endswith('.txt') else song
+
+def render_songbook_html(songs, options, title='Songbook'):
+    ''' Renders dict {song file name: parsed song} into one page with a
+        searchable table of contents, songs sorted by title. '''
+    metas = {song: pre.song_meta(parsed) for song, parsed in songs.items()}
+    order = sorted(songs, key=lambda song: (pre.title_key(metas[song]['title'] or song), song))
+
+    body = ['<h1>{}</h1>\n<input id="search" type="search" placeholder="Search">\n<nav><ul>\n'.format(escape(title))]
+    body.extend('<li><a href="#{}">{}</a></li>\n'.format(escape(slug(song)), escape(metas[song]['title'] or slug(song))) for song in order)
+    body.append('</ul></nav>\n')
+    for song in order:
+        body.append('<article id="{}">\n'.format(escape(slug(song))))
+        body.extend(html_fragments(songs[song], options))
+        body.append('</article>\n')
+    return html_page(title, ''.join(body), SEARCH_SCRIPT)
+
+def markdown_fragments(song, options):
+    ''' Yields Markdown of song parsed by pre.parse_song, chords are kept in
+        their columns above the lyrics in code blocks. '''
+    for section in song.sections:
+
+        if section.kind == pre.INFO:
+            info = section.info
+            yield '# {} ({})\n\n'.format(info['Title'] or '', info['By'] or '')
+            if info['Capo'] and options.capo:
+                yield '**Capo**: {}\n\n'.format(info['Capo'])
+            if options.strumming:
+                for pattern, note in info['Strumming']:
+                    yield '**Strumming**{}: `{}`\n\n'.format(' ' + note if note else '', pattern.strip())
+            if info['Note'] and options.note:
+                yield '**Note**: {}\n\n'.format(info['Note'])
+            yield '**Chords**: {}\n\n'.format(', '.join(chord_label(c) for c in song.chords))
+            continue
+
+        yield '**{}**:\n\n'.format(section.name)
+        if section.kind == pre.CHORDS:
+            yield '`{}`\n\n'.format('  '.join(chord for line in section.lines for chord in line.chords))
+            continue
+
+        yield '```\n'
+        for line in section.lines:
+            if section.kind == pre.MIXED:
+                yield pre.chord_line(line.chords, line.positions) + '\n'
+            yield line.text + '\n'
+        yield '```\n\n'
+
+def render_song_markdown(song, options):
+    ''' Renders song parsed by pre.parse_song into Markdown. '''
+    return ''.join(markdown_fragments(song, options))
+
+def write_web(source_folder, save_folder, options, markdown=False):
+    ''' Renders every song of source_folder into save_folder/<name>.html (or
+        .md) and the whole songbook into save_folder/index.html. Returns a
+        dict of failed songs and their error messages. '''
+    songs, failed = pre.parse_songs(source_folder, options.tab_size)
+    songs = {song: pre.rekey_song(parsed, options) for song, parsed in songs.items()}
+    pre.make_sure_path_exists(save_folder)
+
+    for song, parsed in songs.items():
+        if markdown:
+            pre.write_if_changed(os.path.join(save_folder, slug(song) + '.md'), render_song_markdown(parsed, options))
+        else:
+            title = pre.song_meta(parsed)['title'] or slug(song)
+            pre.write_if_changed(os.path.join(save_folder, slug(song) + '.html'), html_page(title, render_song_html(parsed, options)))
+    if not markdown:
+        pre.write_if_changed(os.path.join(save_folder, 'index.html'), render_songbook_html(songs, options))
+
+    print("Rendered {} songs into {} ({} failed)".format(len(songs), save_folder, len(failed)))
+    for song in sorted(failed):
+        print("  {}: {}".format(song, failed[song]))
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Renders songs into HTML (or Markdown) without TeX.')
+    pre.add_song_options(parser)
+    parser.add_argument('--markdown', action='store_true',
+        help='write Markdown files instead of HTML pages')
+    parser.add_argument('--source', default='songs_txt',
+        help='folder with the songs or a bundle packed by bundle.py')
+    parser.add_argument('--output', default=HTML_FOLDER)
+    args = parser.parse_args(argv)
+    options = pre.song_options(args)
+
+    failed = write_web(args.source, args.output, options, markdown=args.markdown)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())